@@ -0,0 +1,474 @@
+# benchmarks a poll cycle against local stand-ins for the steam web api,
+# the steam community inventory, the csgo gc and discord; everything is
+# seeded, so two runs over the same code make the same requests. gc requests
+# go through the real gc_pool and gevent bridge unless --no-bridge is given
+#
+#   python bench/poll_bench.py --users 10 100 1000 10000 --output bench.json
+#   python bench/poll_bench.py --baseline bench.json
+
+# patched the same way fragminder.main does, before anything else is imported
+from gevent import monkey
+monkey.patch_all()
+
+from aiohttp import web
+from collections import Counter
+from fragminder.database import fmdb
+from fragminder.delivery import alert_dispatcher
+from fragminder.scheduler import poll_scheduler
+from fragminder.steam_utils import steamapi
+from fragminder.update import do_update
+
+import argparse
+import asyncio
+import configparser
+import gevent
+import json
+import logging
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+__all__ = ['bench_world', 'steam_stub', 'gc_answers', 'fake_gc', 'fake_csgo_client', 'fake_discord', 'run_scale']
+
+base_steam_id = 76561198000000000
+inspect_template = 'steam://rungame/730/76561202255233023/+csgo_econ_action_preview%20S%owner_steamid%A%assetid%D{:d}'
+
+
+class bench_world (object):
+    # the state behind all the stand-ins: who owns which assets, what their
+    # counts are, and which assets have been moved to a new id
+
+    def __init__(self, users, seed, weapons_per_user=2, watches_per_weapon=2, class_count=50, online_fraction=0.5, moved_fraction=0.01, users_per_guild=100):
+        self.rng = random.Random(seed)
+        self.seed = seed
+        self.users_per_guild = users_per_guild
+        self.users = [] # (guild_id, discord_id, steam_id)
+        self.weapons = [] # (user index, asset_id, class_id, instance_id, name)
+        self.watches = [] # (weapon index, count)
+        self.online = set()
+        self.inventories = {} # steam_id -> {asset_id: (class_id, instance_id)}
+        self.counts = {} # asset_id -> stattrak count
+        self.moved = {} # old asset_id -> new asset_id
+
+        next_asset = 10000000000
+        for u in range(users):
+            steam_id = base_steam_id + u
+            self.users.append((1 + u // users_per_guild, 100000 + u, steam_id))
+            if self.rng.random() < online_fraction:
+                self.online.add(steam_id)
+            inventory = self.inventories[steam_id] = {}
+            for n in range(weapons_per_user):
+                asset_id = next_asset
+                next_asset += 1
+                class_id = 1000 + self.rng.randrange(class_count)
+                inventory[asset_id] = (class_id, 0)
+                goal = self.rng.randrange(100, 5000)
+                self.counts[asset_id] = goal - self.rng.randrange(0, 30)
+                self.weapons.append((u, asset_id, class_id, 0, 'weapon {:d}'.format(n)))
+                for w in range(watches_per_weapon):
+                    self.watches.append((len(self.weapons) - 1, goal + 100 * w))
+            # some untracked items too, so inventories aren't trivially small
+            for n in range(8):
+                inventory[next_asset] = (1000 + self.rng.randrange(class_count), 0)
+                self.counts[next_asset] = self.rng.randrange(0, 1000)
+                next_asset += 1
+
+        # a few tracked items have been traded around and come back, or been
+        # through a storage unit, and now have a new asset id
+        for u, asset_id, class_id, instance_id, _ in self.weapons:
+            if self.rng.random() < moved_fraction:
+                steam_id = self.users[u][2]
+                new_id = next_asset
+                next_asset += 1
+                del self.inventories[steam_id][asset_id]
+                self.inventories[steam_id][new_id] = (class_id, instance_id)
+                self.counts[new_id] = self.counts.pop(asset_id)
+                self.moved[asset_id] = new_id
+
+    def advance(self):
+        # players keep playing between cycles
+        for asset_id in self.counts:
+            self.counts[asset_id] += self.rng.randrange(0, 4)
+
+    def populate(self, filename):
+        # bulk load straight into sqlite; going through fmdb would commit
+        # every row
+        conn = sqlite3.connect(filename)
+        conn.executemany("insert or ignore into guild_t (guild_id) values (?)", [(g,) for g, _, _ in self.users])
+        conn.executemany("insert into user_t (user_id, guild_id, discord_id, steam_id) values (?, ?, ?, ?)", [(n + 1,) + u for n, u in enumerate(self.users)])
+        conn.executemany("insert into weapon_t (weapon_id, user_id, name, asset_id, class_id, instance_id) values (?, ?, ?, ?, ?, ?)", [(n + 1, u + 1, name, a, c, i) for n, (u, a, c, i, name) in enumerate(self.weapons)])
+        conn.executemany("insert into watch_t (weapon_id, count) values (?, ?)", [(w + 1, count) for w, count in self.watches])
+        conn.commit()
+        conn.close()
+
+
+class steam_stub (object):
+    # serves the three steam endpoints the poller uses
+
+    def __init__(self, world, page_size=1000):
+        self._world = world
+        self._page_size = page_size
+        self.requests = Counter()
+        self._runner = None
+        self.url = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/ISteamUser/GetPlayerSummaries/v0002/', self._summaries)
+        app.router.add_get('/ISteamEconomy/GetAssetClassInfo/v1/', self._class_info)
+        app.router.add_get('/inventory/{steam_id}/730/2', self._inventory)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        self.url = 'http://127.0.0.1:{:d}'.format(site._server.sockets[0].getsockname()[1])
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+    async def _summaries(self, request):
+        self.requests['GetPlayerSummaries'] += 1
+        players = []
+        for steam_id in request.query['steamids'].replace(',', ';').split(';'):
+            player = {'steamid': steam_id, 'personastate': 1}
+            if int(steam_id) in self._world.online:
+                player['gameid'] = '730'
+            players.append(player)
+        return web.json_response({'response': {'players': players}})
+
+    def _description(self, class_id, instance_id):
+        return {
+            'classid': str(class_id),
+            'instanceid': str(instance_id),
+            'name': 'StatTrak™ Bench Rifle {:d}'.format(class_id),
+            'icon_url': 'icon{:d}'.format(class_id),
+            'actions': {'0': {'name': 'Inspect in Game...', 'link': inspect_template.format(class_id * 7)}}
+        }
+
+    async def _class_info(self, request):
+        self.requests['GetAssetClassInfo'] += 1
+        result = {'success': True}
+        for n in range(int(request.query['class_count'])):
+            class_id, instance_id = int(request.query['classid{:d}'.format(n)]), int(request.query['instanceid{:d}'.format(n)])
+            result['{}_{}'.format(class_id, instance_id)] = self._description(class_id, instance_id)
+        return web.json_response({'result': result})
+
+    async def _inventory(self, request):
+        self.requests['inventory'] += 1
+        inventory = sorted(self._world.inventories.get(int(request.match_info['steam_id']), {}).items())
+        start = int(request.query.get('start_assetid', 0))
+        page = [(a, ci) for a, ci in inventory if a > start][:self._page_size]
+        descriptions = {ci: self._description(*ci) for _, ci in page}
+        data = {
+            'assets': [{'assetid': str(a), 'classid': str(c), 'instanceid': str(i), 'amount': '1'} for a, (c, i) in page],
+            'descriptions': [dict(d, actions=list(d['actions'].values())) for d in descriptions.values()],
+            'total_inventory_count': len(inventory),
+            'success': 1
+        }
+        if len(page) > 0 and page[-1][0] != inventory[-1][0]:
+            data['more_items'] = 1
+            data['last_assetid'] = str(page[-1][0])
+        return web.json_response(data)
+
+
+class gc_answers (object):
+    # what the gc says to a preview request: silently drops a seeded fraction
+    # of them like the real gc does, and never answers for assets that no
+    # longer exist
+
+    def __init__(self, world, error_rate=0.01):
+        self._world = world
+        self._error_rate = error_rate
+        self._attempts = Counter()
+        self.requests = 0
+        self.dropped = 0
+
+    def _drop(self, asset_id):
+        # decided per asset and attempt, so it doesn't depend on the order
+        # concurrent requests happen to arrive in
+        self._attempts[asset_id] += 1
+        return random.Random('{}:{}:{}'.format(self._world.seed, asset_id, self._attempts[asset_id])).random() < self._error_rate
+
+    def answer(self, chunk):
+        self.requests += 1
+        res = {}
+        for s, a, d in chunk:
+            if not a in self._world.counts:
+                continue
+            if self._drop(a):
+                self.dropped += 1
+                continue
+            res[(s, a, d)] = self._world.counts[a]
+        return res
+
+
+class fake_gc (object):
+    # stands in for the whole gc_pool, skipping the gevent bridge; answers
+    # preview requests after a fixed latency
+
+    def __init__(self, answers, latency=0.005, chunk_size=8):
+        self._answers = answers
+        self._latency = latency
+        self._chunk_size = chunk_size
+
+    async def start(self):
+        pass
+
+    async def wait_ready(self):
+        pass
+
+    async def _request(self, chunk):
+        await asyncio.sleep(self._latency)
+        return self._answers.answer(chunk)
+
+    async def get_item_killcounts(self, items):
+        items = list(items)
+        res = {}
+        for r in await asyncio.gather(*(self._request(items[i:i+self._chunk_size]) for i in range(0, len(items), self._chunk_size))):
+            res.update(r)
+        return res
+
+
+class fake_csgo_client (object):
+    # stands in for csgo_client on the gevent bridge, so requests go through
+    # the real gc_pool and bridge; blocks its greenlet for the latency like
+    # waiting on the gc would
+
+    def __init__(self, answers, latency=0.005):
+        self._answers = answers
+        self._latency = latency
+        self._status_listeners = []
+
+    def login(self):
+        for fn in self._status_listeners:
+            fn(True)
+
+    def add_status_listener(self, fn):
+        self._status_listeners.append(fn)
+
+    def get_item_killcounts(self, items, timeout=2):
+        gevent.sleep(self._latency)
+        return self._answers.answer(items)
+
+
+class fake_discord (object):
+    # the parts of the discord client the alert dispatcher uses
+
+    class destination (object):
+        def __init__(self, id):
+            self.id = id
+            self.mention = '<@{:d}>'.format(id)
+            self.dm_channel = self
+
+    def __init__(self, latency=0.001):
+        self._latency = latency
+        self.discord_limit = asyncio.Semaphore(4)
+        self.http = self
+        self.messages = 0
+        self.embeds = 0
+
+    def get_user(self, discord_id):
+        return self.destination(discord_id)
+
+    def get_channel(self, channel_id):
+        return self.destination(channel_id)
+
+    async def request(self, route, json):
+        await asyncio.sleep(self._latency)
+        self.messages += 1
+        self.embeds += len(json['embeds'])
+
+
+def bench_config(url, credentials):
+    config = configparser.ConfigParser()
+    config['fragminder'] = {
+        'steam_api_key': 'bench',
+        'steam_bot_username': 'bench',
+        'steam_bot_password': 'bench',
+        'steam_credential_location': credentials,
+        'steam_api_url': url,
+        'steam_community_url': url,
+        # measure the work, not the rate limits
+        'steam_api_rate': '1000000',
+        'steam_api_burst': '1000000',
+        'steam_community_rate': '1000000',
+        'steam_community_burst': '1000000',
+        'gc_rate': '1000000',
+        'gc_burst': '1000000',
+        'poll_min_interval': '0',
+        'user_poll_interval': '0',
+        'poll_jitter': '0',
+        'alert_coalesce_delay': '0',
+        'alert_rate': '1000000',
+        'alert_burst': '1000000'
+    }
+    return config['fragminder']
+
+
+class bench_context (object):
+    # what do_update expects to find on the bot
+
+    def __init__(self, conf, steam, db, discord):
+        self.conf = conf
+        self.steam = steam
+        self.db = db
+        self.scheduler = poll_scheduler.from_config(conf)
+        self.discord = discord
+        self.discord_limit = discord.discord_limit
+        self.http = discord.http
+        self.get_user = discord.get_user
+        self.get_channel = discord.get_channel
+        self.dispatcher = alert_dispatcher(self, conf)
+
+    async def send_alerts(self, discord_id, channel_id, alerts):
+        await self.dispatcher.send(discord_id, channel_id, alerts)
+
+    async def flush_alerts(self):
+        tasks = [q.task for q in self.dispatcher._queues.values() if q.task is not None]
+        if len(tasks) > 0:
+            await asyncio.wait(tasks)
+
+
+async def run_scale(users, cycles, seed, gc_latency, gc_error_rate, workdir, bridge=True):
+    world = bench_world(users, seed)
+    stub = steam_stub(world)
+    await stub.start()
+
+    filename = os.path.join(workdir, 'bench-{:d}.sqlite'.format(users))
+    db = await fmdb.open(filename)
+    await db.close()
+    world.populate(filename)
+
+    load_started = time.perf_counter()
+    db = await fmdb.open(filename)
+    load_time = time.perf_counter() - load_started
+    queries = Counter()
+    for conn in [db._conn] + db._read.connections:
+        await conn.set_trace_callback(lambda sql: queries.update(['queries']))
+
+    conf = bench_config(stub.url, workdir)
+    steam = steamapi(conf)
+    answers = gc_answers(world, gc_error_rate)
+    if bridge:
+        for session in steam._gc._sessions:
+            session.client = steam._bridge.run(fake_csgo_client, answers, gc_latency)
+    else:
+        steam._gc = fake_gc(answers, gc_latency, conf.getint('gc_max_in_flight', 8))
+    await steam.start()
+    steam.attach_db(db)
+    discord = fake_discord()
+    ctx = bench_context(conf, steam, db, discord)
+
+    results = []
+    try:
+        for cycle in range(cycles):
+            requests_before = Counter(steam.request_counts()[0])
+            queries_before = queries['queries']
+            gc_before = answers.requests
+            messages_before, embeds_before = discord.messages, discord.embeds
+
+            started = time.perf_counter()
+            await do_update(ctx)
+            cycle_time = time.perf_counter() - started
+            await ctx.flush_alerts()
+            delivery_time = time.perf_counter() - started - cycle_time
+
+            requests = Counter(steam.request_counts()[0])
+            requests.subtract(requests_before)
+            results.append({
+                'users': users,
+                'cycle': cycle,
+                'cycle_time': round(cycle_time, 4),
+                'delivery_time': round(delivery_time, 4),
+                'requests': {endpoint: n for endpoint, n in sorted(requests.items()) if n > 0},
+                'gc_requests': answers.requests - gc_before,
+                'db_queries': queries['queries'] - queries_before,
+                'alerts': discord.embeds - embeds_before,
+                'messages': discord.messages - messages_before,
+                'index_load_time': round(load_time, 4)
+            })
+            world.advance()
+    finally:
+        await steam.close()
+        await db.close()
+        await stub.stop()
+    return results
+
+
+def print_results(results):
+    print('{:>6} {:>5} {:>9} {:>9} {:>7} {:>7} {:>7} {:>7}  {}'.format('users', 'cycle', 'time (s)', 'send (s)', 'gc', 'db', 'alerts', 'msgs', 'requests'))
+    for r in results:
+        print('{:>6d} {:>5d} {:>9.3f} {:>9.3f} {:>7d} {:>7d} {:>7d} {:>7d}  {}'.format(
+            r['users'], r['cycle'], r['cycle_time'], r['delivery_time'], r['gc_requests'], r['db_queries'], r['alerts'], r['messages'],
+            ' '.join('{}={:d}'.format(endpoint, n) for endpoint, n in r['requests'].items())
+        ))
+
+
+def compare(results, baseline, tolerance):
+    # once the caches are warm, request and query counts are deterministic,
+    # so any increase is a regression; the cold cycle depends a little on
+    # which concurrent lookups fill the caches first, and timings are noisy,
+    # so those get the tolerance
+    failures = []
+    previous = {(r['users'], r['cycle']): r for r in baseline}
+    for r in results:
+        b = previous.get((r['users'], r['cycle']))
+        if b is None:
+            continue
+        where = '{:d} users, cycle {:d}'.format(r['users'], r['cycle'])
+        slack = 1 + tolerance if r['cycle'] == 0 else 1
+        for endpoint in set(r['requests']) | set(b['requests']):
+            if r['requests'].get(endpoint, 0) > b['requests'].get(endpoint, 0) * slack:
+                failures.append('{}: {} requests went from {:d} to {:d}'.format(where, endpoint, b['requests'].get(endpoint, 0), r['requests'].get(endpoint, 0)))
+        for key in ('gc_requests', 'db_queries', 'messages'):
+            if r[key] > b[key] * slack:
+                failures.append('{}: {} went from {:d} to {:d}'.format(where, key, b[key], r[key]))
+        if r['cycle_time'] > b['cycle_time'] * (1 + tolerance):
+            failures.append('{}: cycle time went from {:.3f}s to {:.3f}s'.format(where, b['cycle_time'], r['cycle_time']))
+    return failures
+
+
+async def run(args):
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for users in args.users:
+            results.extend(await run_scale(users, args.cycles, args.seed, args.gc_latency, args.gc_error_rate, workdir, not args.no_bridge))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark poll cycles against local stand-ins for steam, the gc and discord')
+    parser.add_argument('--users', type=int, nargs='+', default=[10, 100, 1000, 10000])
+    parser.add_argument('--cycles', type=int, default=3, help='cycles per scale; the first one starts with cold caches')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--gc-latency', type=float, default=0.005)
+    parser.add_argument('--gc-error-rate', type=float, default=0.01)
+    parser.add_argument('--no-bridge', action='store_true', help='answer gc requests on the event loop instead of through the gevent bridge')
+    parser.add_argument('--output', help='write the results to this json file')
+    parser.add_argument('--baseline', help='compare against results previously written with --output')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative increase in cycle time, and in cold cycle counts, over the baseline')
+    parser.add_argument('--verbose', action='store_true', help="show the poller's warnings, e.g. for items the fake gc never answered")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING if args.verbose else logging.ERROR)
+    results = asyncio.get_event_loop().run_until_complete(run(args))
+    print_results(results)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            failures = compare(results, json.load(f), args.tolerance)
+        for failure in failures:
+            print('REGRESSION: {}'.format(failure))
+        if len(failures) > 0:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+from bisect import bisect_left, bisect_right
+from .cache_utils import lru_dict
+
+__all__ = ['alert_engine', 'default_alert_deltas']
+
+default_alert_deltas = (20, 10, 5, 3, 2, 1)
+
+
+class alert_engine (object):
+    # decides which watches on a weapon should be alerted for, given the count
+    # we saw last time and the count we see now; has no discord or database
+    # dependencies so it can be tested and benchmarked on its own
+
+    def __init__(self, cache_size=1024):
+        self._deltas = lru_dict(cache_size)
+
+    def parse_deltas(self, alert_deltas):
+        # alert_deltas is the comma separated string stored in user_t, or None
+        # for the default; returns the thresholds in ascending order
+        res = self._deltas.get(alert_deltas)
+        if res is None:
+            if alert_deltas is None:
+                res = tuple(sorted(set(default_alert_deltas)))
+            else:
+                res = tuple(sorted(set(map(int, alert_deltas.split(",")))))
+            self._deltas.put(alert_deltas, res)
+        return res
+
+    @staticmethod
+    def _threshold(deltas, delta):
+        # smallest alert threshold at or above delta, or None if delta is
+        # further away than the largest threshold
+        i = bisect_left(deltas, delta)
+        if i < len(deltas):
+            return deltas[i]
+        return None
+
+    def evaluate(self, alert_deltas, last_count, count, watches):
+        # watches is a list of (watch_id, watch_count) sorted by watch_count
+        # returns ([(watch_id, watch_count, hit, delta), ...], distance) where
+        # distance is the number of kills left to the nearest unreached watch
+        deltas = self.parse_deltas(alert_deltas)
+        counts = [watch_count for _, watch_count in watches]
+        first_unreached = bisect_right(counts, count)
+        distance = counts[first_unreached] - count if first_unreached < len(counts) else None
+
+        if last_count is None:
+            last_count = 0
+
+        # nothing to say if the count hasn't moved
+        if count <= last_count:
+            return [], distance
+
+        # watches we've reached are hits
+        alerts = [(watch_id, watch_count, True, 0) for watch_id, watch_count in watches[:first_unreached]]
+
+        for watch_id, watch_count in watches[first_unreached:]:
+            delta = watch_count - count
+            this_alert = self._threshold(deltas, delta)
+            if this_alert is None: # we haven't passed the first alert threshold yet; neither will any later watch
+                break
+            # skip if we would already have sent this alert
+            if this_alert == self._threshold(deltas, watch_count - last_count):
+                continue
+            alerts.append((watch_id, watch_count, False, delta))
+
+        return alerts, distance
@@ -1,25 +1,32 @@
 import asyncio
 import logging
+import random
 
-__all__ = ['recurring_task']
+__all__ = ['recurring_task', 'task_pool']
 
 class recurring_task (object):
-    def __init__(self, delta_time, fn, *args):
+    def __init__(self, delta_time, fn, *args, jitter=0):
         self._delta_time = delta_time
         self._fn = fn
         self._args = args
+        self._jitter = jitter
         
     async def start(self):
         self._task = asyncio.ensure_future(self._run())
 
     async def _run(self):
+        loop = asyncio.get_event_loop()
+        next_run = loop.time()
         while True:
             try:
                 await self._fn(*self._args)
             except Exception as e:
                 logging.error("failed recurring task")
                 logging.exception(e)
-            await asyncio.sleep(self._delta_time)
+            # keep a fixed cadence regardless of how long the run took; if we
+            # overran, start again immediately rather than trying to catch up
+            next_run = max(next_run + self._delta_time, loop.time())
+            await asyncio.sleep(max(0, next_run - loop.time() + random.uniform(0, self._jitter)))
 
     async def stop(self):
         self._task.cancel()
@@ -27,3 +34,27 @@ class recurring_task (object):
             await self._task
         except asyncio.CancelledError:
             pass
+
+
+# runs awaitables as they are submitted, at most limit at a time; failures are
+# logged and returned in place of the result rather than cancelling the others
+class task_pool (object):
+    def __init__(self, limit):
+        self._sem = asyncio.Semaphore(limit)
+        self._tasks = []
+
+    async def _run(self, aw):
+        async with self._sem:
+            try:
+                return await aw
+            except Exception as e:
+                logging.error("failed concurrent task")
+                logging.exception(e)
+                return e
+
+    def submit(self, aw):
+        self._tasks.append(asyncio.ensure_future(self._run(aw)))
+
+    async def join(self):
+        return await asyncio.gather(*self._tasks)
+
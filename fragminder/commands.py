@@ -1,5 +1,6 @@
 from .steam_utils import *
 from .help import format_help
+from .metrics import registry
 from . import emoji
 
 __all__ = ['process_command']
@@ -178,6 +179,28 @@ async def setchannel(ctx, msg, *args):
     return {'react': emoji.thumbsup}
 
 
+@cmd("stats")
+async def stats(ctx, msg, *args):
+    """ * desc: show how polling has been going (admin)
+    """
+    perms = msg.author.permissions_in(msg.channel)
+    if not perms.administrator:
+        return {'react': emoji.thumbsdown}
+
+    lines = registry.summary()
+    if len(lines) == 0:
+        return {'reply': "nothing to report yet"}
+
+    # keep within discord's message length, leaving room for the mention
+    reply = ""
+    for line in lines:
+        if len(reply) + len(line) + 16 > 1900:
+            reply += "\n..."
+            break
+        reply += "\n" + line
+    return {'reply': "```{}\n```".format(reply)}
+
+
 @cmd("remind")
 async def remind(ctx, msg, *args):
     """ * desc: set increments for watch reminders
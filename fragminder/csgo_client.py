@@ -1,17 +1,31 @@
 from steam.client import SteamClient
 from csgo.client import CSGOClient
-from csgo.enums import ECsgoGCMsg, GCConnectionStatus
+from csgo.enums import ECsgoGCMsg
+from gevent.event import AsyncResult, Event
+from gevent.lock import BoundedSemaphore
+import gevent
 import logging
 
 __all__ = ['csgo_client']
 
 class csgo_client (object):
-    def __init__(self, config):
+    def __init__(self, config, username, password, reconnect_timeout):
+        self._username = username
+        self._password = password
         self._client = SteamClient()
         self._client.set_credential_location(config["steam_credential_location"])
         self._cs = CSGOClient(self._client)
 
-        self._ready = False
+        # set while we have a gc session; _session counts how many we've had
+        self._ready = Event()
+        self._session = 0
+        self._status_listeners = []
+        self._reconnect_timeout = reconnect_timeout
+        self._login_timeout = config.getfloat('gc_login_timeout', 60)
+
+        # preview requests awaiting a response, keyed by item id
+        self._pending = {}
+        self._in_flight = BoundedSemaphore(config.getint('gc_max_in_flight', 8))
 
         @self._client.on("channel_secured")
         def send_login():
@@ -21,6 +35,7 @@ class csgo_client (object):
         @self._client.on("disconnected")
         def handle_disconnect():
             logging.warning("disconnected from steam")
+            self._set_ready(False)
             if self._client.relogin_available:
                 self._client.reconnect(maxdelay=10)
 
@@ -32,12 +47,41 @@ class csgo_client (object):
         @self._cs.on('ready')
         def gc_ready():
             logging.info("connected")
-            self._ready = True
+            self._set_ready(True)
+            # resend whatever was in flight when we lost the previous session
+            for result, (s, a, d) in list(self._pending.values()):
+                self._send_preview_request(s, a, d)
+
+        @self._cs.on('notready')
+        def gc_notready():
+            logging.warning("lost gc session")
+            self._set_ready(False)
+
+        @self._cs.on(ECsgoGCMsg.EMsgGCCStrike15_v2_Client2GCEconPreviewDataBlockResponse)
+        def handle_preview(response):
+            pending = self._pending.pop(response.iteminfo.itemid, None)
+            if pending is not None: # otherwise a late reply to a request that already timed out
+                pending[0].set(response.iteminfo.killeatervalue)
+
+    def login(self):
+        # blocks until the first gc session is up, or gc_login_timeout; may
+        # prompt for a 2fa code. on a timeout the session still comes up in
+        # the background whenever the gc answers
+        self._client.cli_login(username=self._username, password=self._password)
+        if not self._ready.wait(self._login_timeout):
+            raise ValueError("no gc session after {:g}s".format(self._login_timeout))
 
-        self._client.cli_login(username=config["steam_bot_username"], password=config["steam_bot_password"])
+    def add_status_listener(self, fn):
+        self._status_listeners.append(fn)
 
-        while not self._ready:
-            self._client.sleep(0.125)        
+    def _set_ready(self, ready):
+        if ready:
+            self._session += 1
+            self._ready.set()
+        else:
+            self._ready.clear()
+        for fn in self._status_listeners:
+            fn(ready)
 
     def send(self, *args, **kwargs):
         self._cs.send(*args, **kwargs)
@@ -45,18 +89,53 @@ class csgo_client (object):
     def wait_event(self, *args, **kwargs):
         return self._cs.wait_event(*args, **kwargs)
 
-    def get_item_killcount(self, s, a, d):
-        if not self._cs.connection_status == GCConnectionStatus.HAVE_SESSION:
-            logging.warning("not connected to GC")
-            raise ValueError("not connected to gc")
-
+    def _send_preview_request(self, s, a, d):
         self.send(ECsgoGCMsg.EMsgGCCStrike15_v2_Client2GCEconPreviewDataBlockRequest, {
             'param_s': s,
             'param_a': a,
             'param_d': d,
             'param_m': 0
         })
-        response, = self.wait_event(ECsgoGCMsg.EMsgGCCStrike15_v2_Client2GCEconPreviewDataBlockResponse, timeout=2)
-        if response.iteminfo.itemid != a:
-            raise ValueError("mismatched req/rep")
-        return response.iteminfo.killeatervalue
+
+    def _request_killcount(self, s, a, d, timeout):
+        with self._in_flight:
+            pending = self._pending.get(a)
+            if pending is None:
+                pending = self._pending[a] = AsyncResult(), (s, a, d)
+                if self._ready.is_set(): # otherwise it's sent once we reconnect
+                    self._send_preview_request(s, a, d)
+            result, _ = pending
+            while True:
+                session = self._session
+                try:
+                    return result.get(timeout=timeout)
+                except gevent.Timeout:
+                    pass
+                # if the session dropped while we were waiting, the request is
+                # resent on reconnect, so wait for that and give it another go
+                if self._session == session and self._ready.is_set():
+                    break
+                if not self._ready.wait(self._reconnect_timeout):
+                    break
+            if self._pending.get(a) is pending:
+                del self._pending[a]
+            return None
+
+    def get_item_killcounts(self, items, timeout=2):
+        if not self._ready.wait(self._reconnect_timeout):
+            logging.warning("not connected to GC")
+            raise ValueError("not connected to gc")
+
+        # keep up to gc_max_in_flight requests outstanding at once; replies are
+        # matched to requests by item id, so they may arrive in any order
+        jobs = [gevent.spawn(self._request_killcount, s, a, d, timeout) for s, a, d in items]
+        gevent.joinall(jobs)
+
+        # items which timed out are omitted from the result
+        return {item: job.value for item, job in zip(items, jobs) if job.value is not None}
+
+    def get_item_killcount(self, s, a, d):
+        res = self.get_item_killcounts([(s, a, d)])
+        if not (s, a, d) in res:
+            raise ValueError("no response from gc")
+        return res[(s, a, d)]
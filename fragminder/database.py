@@ -1,21 +1,183 @@
+from .cache_utils import lru_dict
+from .metrics import db_duration, timed
+from .watch_index import watch_index
 import aiosqlite
+import asyncio
+import os
+import urllib.parse
+
+__all__ = ['fmdb', 'poll_batch']
+
+class poll_batch (object):
+    def __init__(self, db):
+        self._db = db
+        self._weapon_updates = []
+        self._removed_watches = []
+        self._relinked_weapons = []
+        self._killcounts = []
+
+    def update_weapon(self, weapon_id, last_count, last_check):
+        self._weapon_updates.append((last_count, last_check, weapon_id))
+
+    def remove_watch(self, watch_id):
+        self._removed_watches.append((watch_id,))
+
+    def relink_weapon(self, weapon_id, asset_id, class_id, instance_id):
+        self._relinked_weapons.append((asset_id, class_id, instance_id, weapon_id))
+
+    def record_killcount(self, weapon_id, time, count):
+        self._killcounts.append((weapon_id, time, count))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        # results collected before a failure are still valid, so always flush
+        await self._db.write_batch(self._weapon_updates, self._removed_watches, self._relinked_weapons, self._killcounts)
+
+
+class read_pool (object):
+    # read-only connections handed out one query at a time, so that reads
+    # neither queue behind the writer nor behind each other; with no readers
+    # (e.g. an in-memory database) everything goes through the writer
+
+    def __init__(self, writer, readers):
+        self._writer = writer
+        self.connections = readers
+        self._idle = asyncio.Queue()
+        for conn in readers:
+            self._idle.put_nowait(conn)
+
+    def __call__(self):
+        return read_connection(self)
+
+
+class read_connection (object):
+    def __init__(self, pool):
+        self._pool = pool
+        self._conn = None
+
+    async def __aenter__(self):
+        if len(self._pool.connections) == 0:
+            return self._pool._writer
+        self._conn = await self._pool._idle.get()
+        return self._conn
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self._conn is not None:
+            self._pool._idle.put_nowait(self._conn)
+
+
+class write_transaction (object):
+    # the writer is shared, so each write holds it for a whole transaction;
+    # commits on success and rolls back on any error, so no other write can
+    # interleave with it or commit half of it
+    def __init__(self, db):
+        self._db = db
+
+    async def __aenter__(self):
+        await self._db._write_lock.acquire()
+        return self._db._conn
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                try:
+                    await self._db._conn.commit()
+                except BaseException:
+                    await self._db._conn.rollback()
+                    raise
+            else:
+                await self._db._conn.rollback()
+        finally:
+            self._db._write_lock.release()
 
-__all__ = ['fmdb']
 
 class fmdb (object):
 
+    # statements are cached per connection by sql text, so queries keep their
+    # text constant and pass everything else as parameters
+    cached_statements = 256
+
     @classmethod
-    async def open(cls, filename):
-        res = cls(await aiosqlite.connect(filename))
-        await res._init()
+    async def open(cls, filename, readers=2, cache_size=8192, lookup_cache_size=4096):
+        # cache_size is in KiB, per connection
+        res = cls(await aiosqlite.connect(filename, cached_statements=cls.cached_statements), lookup_cache_size)
+        await res._init(filename, readers, cache_size)
         return res
 
-    def __init__(self, connection):
+    def __init__(self, connection, lookup_cache_size=4096):
         self._conn = connection
         self._conn.row_factory = aiosqlite.Row
+        self._read = read_pool(connection, [])
+        self._write_lock = asyncio.Lock()
+        self.index = watch_index()
+        # nearly every command starts by looking up the user and often the
+        # weapon by name; these only change through the methods below, which
+        # invalidate them. a lookup that was already running when something
+        # was invalidated may have read the old value, so it isn't cached
+        self._user_ids = lru_dict(lookup_cache_size)
+        self._weapon_ids = lru_dict(lookup_cache_size)
+        self._lookup_generation = 0
+
+    def _write(self):
+        # the index is only updated once the block has committed
+        return write_transaction(self)
 
-    async def _init(self):
+    def _invalidate_lookup(self, cache, key=None):
+        self._lookup_generation += 1
+        if key is None:
+            cache.clear()
+        else:
+            cache.invalidate(key)
+
+    async def _init(self, filename, readers, cache_size):
+        # wal lets the readers carry on while the writer commits; with it,
+        # synchronous=normal only risks the last commits on power loss, never
+        # corruption
+        async with self._conn.execute("pragma journal_mode = wal") as c:
+            journal_mode = (await c.fetchone())[0]
+        await self._conn.execute("pragma synchronous = normal")
+        await self._conn.execute("pragma cache_size = -{:d}".format(cache_size))
+        await self._conn.execute("pragma busy_timeout = 5000")
         await self._run_ddl()
+        await self._load_index()
+        if journal_mode == 'wal' and readers > 0:
+            self._read = read_pool(self._conn, [await self._open_reader(filename, cache_size) for _ in range(readers)])
+
+    async def _open_reader(self, filename, cache_size):
+        uri = 'file:{}?mode=ro'.format(urllib.parse.quote(os.path.abspath(filename)))
+        conn = await aiosqlite.connect(uri, uri=True, cached_statements=self.cached_statements)
+        conn.row_factory = aiosqlite.Row
+        await conn.execute("pragma query_only = on")
+        await conn.execute("pragma cache_size = -{:d}".format(cache_size))
+        await conn.execute("pragma busy_timeout = 5000")
+        return conn
+
+    async def close(self):
+        for conn in self._read.connections:
+            await conn.close()
+        await self._conn.close()
+
+    @timed(db_duration, 'load_index')
+    async def _load_index(self):
+        # the index is loaded once here; after that every write below keeps it
+        # in step with the database
+        async with self._conn.execute("select guild_id, channel_id from guild_t") as c:
+            async for row in c:
+                self.index.set_channel(row['guild_id'], row['channel_id'])
+        async with self._conn.execute("select user_id, guild_id, discord_id, steam_id, alert_deltas from user_t") as c:
+            async for row in c:
+                self.index.add_user(row['user_id'], row['guild_id'], row['discord_id'], row['steam_id'], row['alert_deltas'])
+        async with self._conn.execute("select weapon_id, user_id, name, asset_id, class_id, instance_id, last_count, last_check from weapon_t") as c:
+            async for row in c:
+                self.index.add_weapon(row['weapon_id'], row['user_id'], row['name'], row['asset_id'], row['class_id'], row['instance_id'], row['last_count'], row['last_check'])
+        async with self._conn.execute("select watch_id, weapon_id, count from watch_t") as c:
+            async for row in c:
+                self.index.add_watch(row['watch_id'], row['weapon_id'], row['count'])
+
+    async def watch_index(self):
+        return self.index
     
     async def _run_ddl(self):
 
@@ -62,107 +224,278 @@ class fmdb (object):
             )
         """)
 
+        await self._conn.execute("create index if not exists weapon_user_idx on weapon_t (user_id)")
+        await self._conn.execute("create index if not exists watch_weapon_idx on watch_t (weapon_id)")
+
+        await self._conn.execute("""
+            create table if not exists killcount_t (
+                killcount_id integer primary key autoincrement,
+                weapon_id integer not null,
+                time real not null,
+                count integer not null,
+                foreign key (weapon_id) references weapon_t (weapon_id)
+            )
+        """)
+
+        await self._conn.execute("create index if not exists killcount_weapon_time_idx on killcount_t (weapon_id, time)")
+
+        await self._conn.execute("""
+            create table if not exists classinfo_t (
+                class_id integer not null,
+                instance_id integer not null,
+                name text not null,
+                icon_url text not null,
+                inspect_link text null,
+                primary key (class_id, instance_id)
+            )
+        """)
+
         await self._conn.commit()
 
+    @timed(db_duration, 'add_or_update_guild')
     async def add_or_update_guild(self, guild_id, channel_id=None):
+        async with self._write() as conn:
+            if channel_id:
+                await conn.execute("replace into guild_t (guild_id, channel_id) values (?, ?)", (guild_id, channel_id))
+            else:
+                await conn.execute("insert or ignore into guild_t (guild_id) values (?)", (guild_id,))
         if channel_id:
-            await self._conn.execute("replace into guild_t (guild_id, channel_id) values (?, ?)", (guild_id, channel_id))
-        else:
-            await self._conn.execute("insert or ignore into guild_t (guild_id) values (?)", (guild_id,))
-        await self._conn.commit()
+            self.index.set_channel(guild_id, channel_id)
 
+    @timed(db_duration, 'add_user')
     async def add_user(self, guild_id, discord_id, steam_id):
-        await self._conn.execute("insert into user_t (guild_id, discord_id, steam_id) values (?, ?, ?)", (guild_id, discord_id, steam_id))
-        await self._conn.commit()
+        async with self._write() as conn:
+            c = await conn.execute("insert into user_t (guild_id, discord_id, steam_id) values (?, ?, ?)", (guild_id, discord_id, steam_id))
+        self._invalidate_lookup(self._user_ids, (guild_id, discord_id))
+        self.index.add_user(c.lastrowid, guild_id, discord_id, steam_id)
 
+    @timed(db_duration, 'add_weapon')
     async def add_weapon(self, user_id, asset_id, class_id, instance_id, name):
-        await self._conn.execute("insert into weapon_t (user_id, asset_id, class_id, instance_id, name) values (?, ?, ?, ?, ?)", (user_id, asset_id, class_id, instance_id, name))
-        await self._conn.commit()
+        async with self._write() as conn:
+            c = await conn.execute("insert into weapon_t (user_id, asset_id, class_id, instance_id, name) values (?, ?, ?, ?, ?)", (user_id, asset_id, class_id, instance_id, name))
+        self._invalidate_lookup(self._weapon_ids, (user_id, name))
+        self.index.add_weapon(c.lastrowid, user_id, name, asset_id, class_id, instance_id)
 
+    @timed(db_duration, 'reid_weapon')
     async def reid_weapon(self, user_id, asset_id, class_id, instance_id, name):
-        await self._conn.execute("update weapon_t set asset_id = ?, class_id = ?, instance_id = ? where user_id = ? and name = ?", (asset_id, class_id, instance_id, user_id, name))
-        await self._conn.commit()
+        async with self._write() as conn:
+            await conn.execute("update weapon_t set asset_id = ?, class_id = ?, instance_id = ? where user_id = ? and name = ?", (asset_id, class_id, instance_id, user_id, name))
+        self._invalidate_lookup(self._weapon_ids, (user_id, name))
+        self.index.reid_weapon(user_id, asset_id, class_id, instance_id, name)
 
+    @timed(db_duration, 'add_watch')
     async def add_watch(self, weapon_id, count):
-        await self._conn.execute("insert into watch_t (weapon_id, count) values (?, ?)", (weapon_id, count))
-        await self._conn.commit()
+        async with self._write() as conn:
+            c = await conn.execute("insert into watch_t (weapon_id, count) values (?, ?)", (weapon_id, count))
+        self.index.add_watch(c.lastrowid, weapon_id, count)
 
+    @timed(db_duration, 'set_alert_deltas')
     async def set_alert_deltas(self, user_id, deltas):
         deltas = ",".join(map(str, deltas))
-        await self._conn.execute("update user_t set alert_deltas = ? where user_id = ?", (deltas, user_id))
-        await self._conn.commit()
+        async with self._write() as conn:
+            await conn.execute("update user_t set alert_deltas = ? where user_id = ?", (deltas, user_id))
+        self.index.set_alert_deltas(user_id, deltas)
 
+    @timed(db_duration, 'get_alert_deltas')
     async def get_alert_deltas(self, user_id):
-        async with self._conn.execute("select alert_deltas from user_t where user_id = ?", (user_id, )) as c:
-            async for row in c:
-                return row['alert_deltas']
+        async with self._read() as conn:
+            async with conn.execute("select alert_deltas from user_t where user_id = ?", (user_id, )) as c:
+                async for row in c:
+                    return row['alert_deltas']
 
+    @timed(db_duration, 'get_guild')
     async def get_guild(self, guild_id):
-        async with self._conn.execute("select * from guild_t where guild_id = ?", (guild_id, )) as c:
-            async for row in c:
-                return row['channel_id']
+        async with self._read() as conn:
+            async with conn.execute("select channel_id from guild_t where guild_id = ?", (guild_id, )) as c:
+                async for row in c:
+                    return row['channel_id']
 
+    @timed(db_duration, 'get_users')
     async def get_users(self):
         res = []
-        async with self._conn.execute("select * from user_t") as c:
-            async for row in c:
-                res.append((row['guild_id'], row['user_id'], row['discord_id'], row['steam_id'], row['alert_deltas']))
+        async with self._read() as conn:
+            async with conn.execute("select * from user_t") as c:
+                async for row in c:
+                    res.append((row['guild_id'], row['user_id'], row['discord_id'], row['steam_id'], row['alert_deltas']))
         return res
 
+    @timed(db_duration, 'get_user_id')
     async def get_user_id(self, guild_id, discord_id):
-        async with self._conn.execute("select * from user_t where guild_id = ? and discord_id = ?", (guild_id, discord_id,)) as c:
-            async for row in c:
-                return row['user_id'], row['steam_id']
+        res = self._user_ids.get((guild_id, discord_id))
+        if res is not None:
+            return res
+        generation = self._lookup_generation
+        async with self._read() as conn:
+            async with conn.execute("select user_id, steam_id from user_t where guild_id = ? and discord_id = ?", (guild_id, discord_id,)) as c:
+                async for row in c:
+                    res = row['user_id'], row['steam_id']
+                    if generation == self._lookup_generation:
+                        self._user_ids.put((guild_id, discord_id), res)
+                    return res
         return None
 
+    @timed(db_duration, 'get_weapon_id')
     async def get_weapon_id(self, user_id, name):
-        async with self._conn.execute("select * from weapon_t where name = ? and user_id = ?", (name, user_id)) as c:
-            async for row in c:
-                return row['weapon_id']
+        res = self._weapon_ids.get((user_id, name))
+        if res is not None:
+            return res
+        generation = self._lookup_generation
+        async with self._read() as conn:
+            async with conn.execute("select weapon_id from weapon_t where name = ? and user_id = ?", (name, user_id)) as c:
+                async for row in c:
+                    if generation == self._lookup_generation:
+                        self._weapon_ids.put((user_id, name), row['weapon_id'])
+                    return row['weapon_id']
         return None
 
+    @timed(db_duration, 'get_user_weapons')
     async def get_user_weapons(self, user_id):
         res = []
-        async with self._conn.execute("select * from weapon_t where user_id = ?", (user_id,)) as c:
-            async for row in c:
-                res.append((row['weapon_id'], row['name'], row['last_count']))
+        async with self._read() as conn:
+            async with conn.execute("select weapon_id, name, last_count from weapon_t where user_id = ?", (user_id,)) as c:
+                async for row in c:
+                    res.append((row['weapon_id'], row['name'], row['last_count']))
         return res
 
+    @timed(db_duration, 'get_user_watches')
     async def get_user_watches(self, user_id):
         res = []
-        async with self._conn.execute("""\
-            select watch_id, weapon_t.weapon_id, asset_id, class_id, instance_id, count, name, last_count, last_check
-            from watch_t
-            left join weapon_t on watch_t.weapon_id = weapon_t.weapon_id
-            where weapon_t.user_id = ?\
-        """, (user_id,)) as c:
-            async for row in c:
-                res.append((row['watch_id'], row['weapon_id'], row['name'], row['asset_id'], row['class_id'], row['instance_id'], row['count'], row['last_count'], row['last_check']))
+        async with self._read() as conn:
+            async with conn.execute("""\
+                select watch_id, weapon_t.weapon_id, asset_id, class_id, instance_id, count, name, last_count, last_check
+                from watch_t
+                left join weapon_t on watch_t.weapon_id = weapon_t.weapon_id
+                where weapon_t.user_id = ?\
+            """, (user_id,)) as c:
+                async for row in c:
+                    res.append((row['watch_id'], row['weapon_id'], row['name'], row['asset_id'], row['class_id'], row['instance_id'], row['count'], row['last_count'], row['last_check']))
         return res
 
+    @timed(db_duration, 'update_weapon')
     async def update_weapon(self, weapon_id, last_count, last_check):
-        await self._conn.execute("""\
-            update weapon_t
-            set last_count = ?, last_check = ?
-            where weapon_id = ?
-        """, (last_count, last_check, weapon_id))
-        await self._conn.commit()
+        async with self._write() as conn:
+            await conn.execute("""\
+                update weapon_t
+                set last_count = ?, last_check = ?
+                where weapon_id = ?
+            """, (last_count, last_check, weapon_id))
+        self.index.update_weapon(weapon_id, last_count, last_check)
+
+    def batch(self):
+        return poll_batch(self)
+
+    @timed(db_duration, 'write_batch')
+    async def write_batch(self, weapon_updates, removed_watches, relinked_weapons, killcounts):
+        if len(weapon_updates) == 0 and len(removed_watches) == 0 and len(relinked_weapons) == 0 and len(killcounts) == 0:
+            return
+        async with self._write() as conn:
+            await conn.executemany("insert into killcount_t (weapon_id, time, count) values (?, ?, ?)", killcounts)
+            await conn.executemany("update weapon_t set asset_id = ?, class_id = ?, instance_id = ? where weapon_id = ?", relinked_weapons)
+            await conn.executemany("""\
+                update weapon_t
+                set last_count = ?, last_check = ?
+                where weapon_id = ?
+            """, weapon_updates)
+            await conn.executemany("delete from watch_t where watch_id = ?", removed_watches)
+        self.index.apply_batch(weapon_updates, removed_watches, relinked_weapons)
+
+    @timed(db_duration, 'get_killcount_changes')
+    async def get_killcount_changes(self, since_id=0, limit=1000):
+        # change feed over the killcount history; pass the last killcount_id
+        # seen to get the changes recorded after it
+        res = []
+        async with self._read() as conn:
+            async with conn.execute("""\
+                select killcount_id, weapon_id, time, count
+                from killcount_t
+                where killcount_id > ?
+                order by killcount_id
+                limit ?
+            """, (since_id, limit)) as c:
+                async for row in c:
+                    res.append((row['killcount_id'], row['weapon_id'], row['time'], row['count']))
+        return res
+
+    @timed(db_duration, 'get_killcount_history')
+    async def get_killcount_history(self, weapon_id, since=0):
+        res = []
+        async with self._read() as conn:
+            async with conn.execute("""\
+                select time, count
+                from killcount_t
+                where weapon_id = ? and time >= ?
+                order by time
+            """, (weapon_id, since)) as c:
+                async for row in c:
+                    res.append((row['time'], row['count']))
+        return res
 
+    @timed(db_duration, 'get_kill_rate')
+    async def get_kill_rate(self, weapon_id, since):
+        # kills per minute between the first and last change recorded since the given time
+        async with self._read() as conn:
+            async with conn.execute("""\
+                select min(time) as first_time, max(time) as last_time, min(count) as first_count, max(count) as last_count
+                from killcount_t
+                where weapon_id = ? and time >= ?
+            """, (weapon_id, since)) as c:
+                async for row in c:
+                    if row['first_time'] is None or row['last_time'] == row['first_time']:
+                        return None
+                    return 60 * (row['last_count'] - row['first_count']) / (row['last_time'] - row['first_time'])
+        return None
+
+    @timed(db_duration, 'get_watch_id')
     async def get_watch_id(self, user_id, name, count):
-        async with self._conn.execute("""\
-            select watch_id
-            from watch_t
-            left join weapon_t on watch_t.weapon_id = weapon_t.weapon_id
-            where name = ? and count = ? and user_id = ?
-        """, (name, count, user_id)) as c:
-            async for row in c:
-                return row['watch_id']
+        async with self._read() as conn:
+            async with conn.execute("""\
+                select watch_id
+                from watch_t
+                left join weapon_t on watch_t.weapon_id = weapon_t.weapon_id
+                where name = ? and count = ? and user_id = ?
+            """, (name, count, user_id)) as c:
+                async for row in c:
+                    return row['watch_id']
         return None
 
+    @timed(db_duration, 'remove_watch')
     async def remove_watch(self, watch_id):
-        await self._conn.execute("delete from watch_t where watch_id = ?", (watch_id,))
-        await self._conn.commit()
+        async with self._write() as conn:
+            await conn.execute("delete from watch_t where watch_id = ?", (watch_id,))
+        self.index.remove_watch(watch_id)
 
+    @timed(db_duration, 'rename_weapon')
     async def rename_weapon(self, weapon_id, name):
-        await self._conn.execute("update weapon_t set name = ? where weapon_id = ?", (name, weapon_id))
-        await self._conn.commit()
+        async with self._write() as conn:
+            await conn.execute("update weapon_t set name = ? where weapon_id = ?", (name, weapon_id))
+        weapon = self.index.weapon(weapon_id)
+        if weapon is not None:
+            self._invalidate_lookup(self._weapon_ids, (weapon.user.user_id, weapon.name))
+            self._invalidate_lookup(self._weapon_ids, (weapon.user.user_id, name))
+        else:
+            self._invalidate_lookup(self._weapon_ids)
+        self.index.rename_weapon(weapon_id, name)
+
+    @timed(db_duration, 'get_class_infos')
+    async def get_class_infos(self, keys):
+        keys = list(keys)
+        max_keys_per_query = 400 # stay below sqlite's bound parameter limit
+        res = {}
+        async with self._read() as conn:
+            for i in range(0, len(keys), max_keys_per_query):
+                keys_subset = keys[i:i+max_keys_per_query]
+                async with conn.execute("""\
+                    select * from classinfo_t
+                    where (class_id, instance_id) in (values {})
+                """.format(", ".join(["(?, ?)"] * len(keys_subset))), [v for key in keys_subset for v in key]) as c:
+                    async for row in c:
+                        res[(row['class_id'], row['instance_id'])] = (row['name'], row['icon_url'], row['inspect_link'])
+        return res
+
+    @timed(db_duration, 'add_class_infos')
+    async def add_class_infos(self, infos):
+        async with self._write() as conn:
+            await conn.executemany("""\
+                replace into classinfo_t (class_id, instance_id, name, icon_url, inspect_link)
+                values (?, ?, ?, ?, ?)
+            """, [(class_id, instance_id, name, icon_url, inspect_link) for (class_id, instance_id), (name, icon_url, inspect_link) in infos.items()])
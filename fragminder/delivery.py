@@ -0,0 +1,169 @@
+from collections import deque
+from discord.http import Route
+from .cache_utils import lru_dict
+from .metrics import request_duration, requests_total, alerts_sent
+from .ratelimit import token_bucket
+import asyncio
+import discord
+import logging
+import time
+
+__all__ = ['alert_dispatcher']
+
+# discord's limits for a single message
+max_embeds_per_message = 10
+max_message_length = 2000
+
+
+def format_alert(mention, alert):
+    embed = discord.Embed()
+    embed.set_image(url=alert['image'])
+    if alert['hit']:
+        msg = "{}: you've hit your goal of {:d} on your {:s} (`{:s}`)! hope you got the screenshot~~".format(mention, alert['watch_count'], alert['item_name'], alert['weapon_name'])
+    else:
+        msg = "{}: you're {:d} away from your goal of {:d} on your {:s} (`{:s}`)!".format(mention, alert['delta'], alert['watch_count'], alert['item_name'], alert['weapon_name'])
+    return msg, embed
+
+
+class destination_queue (object):
+    __slots__ = ('channel', 'messages', 'bucket', 'task')
+
+    def __init__(self, channel, bucket):
+        self.channel = channel
+        self.messages = deque()
+        self.bucket = bucket
+        self.task = None
+
+
+class destination_cache (object):
+    # resolved users and channels, kept for a while so that alerting doesn't
+    # cost a REST call per user per cycle; the client's own cache is always
+    # tried first and gateway events invalidate entries that went stale
+
+    def __init__(self, ctx, config):
+        self._ctx = ctx
+        self._ttl = config.getfloat('discord_resolve_ttl', 600)
+        self._users = lru_dict(config.getint('discord_resolve_cache_size', 4096))
+        self._channels = lru_dict(config.getint('discord_resolve_cache_size', 4096))
+
+    def _lookup(self, cache, key):
+        entry = cache.get(key)
+        if entry is None:
+            return None
+        value, expires = entry
+        if time.monotonic() >= expires:
+            cache.invalidate(key)
+            return None
+        return value
+
+    async def user(self, discord_id):
+        user = self._lookup(self._users, discord_id)
+        if user is None:
+            user = self._ctx.get_user(discord_id)
+            if user is None:
+                async with self._ctx.discord_limit:
+                    user = await self._ctx.fetch_user(discord_id)
+            self._users.put(discord_id, (user, time.monotonic() + self._ttl))
+        return user
+
+    async def channel(self, user, channel_id):
+        if not channel_id:
+            # dm channels are cached by the client once created
+            channel = user.dm_channel
+            if channel is None:
+                async with self._ctx.discord_limit:
+                    channel = await user.create_dm()
+            return channel
+
+        channel = self._lookup(self._channels, channel_id)
+        if channel is None:
+            channel = self._ctx.get_channel(channel_id)
+            if channel is None:
+                try:
+                    async with self._ctx.discord_limit:
+                        channel = await self._ctx.fetch_channel(channel_id)
+                except (discord.NotFound, discord.Forbidden):
+                    return None
+            self._channels.put(channel_id, (channel, time.monotonic() + self._ttl))
+        return channel
+
+    def invalidate_user(self, discord_id):
+        self._users.invalidate(discord_id)
+
+    def invalidate_channel(self, channel_id):
+        self._channels.invalidate(channel_id)
+
+
+class alert_dispatcher (object):
+    # alerts are queued per destination channel; each queue is drained by its
+    # own task, which merges whatever has accumulated into as few messages as
+    # possible, so different destinations are served concurrently while each
+    # one sees its alerts in order
+
+    def __init__(self, ctx, config):
+        self._ctx = ctx
+        self._delay = config.getfloat('alert_coalesce_delay', 1)
+        self._rate = config.getfloat('alert_rate', 1)
+        self._burst = config.getint('alert_burst', 5)
+        self._queues = {}
+        self.destinations = destination_cache(ctx, config)
+
+    async def _resolve(self, discord_id, channel_id):
+        # only called once there's something to send
+        user = await self.destinations.user(discord_id)
+        return user, await self.destinations.channel(user, channel_id)
+
+    async def send(self, discord_id, channel_id, alerts):
+        user, channel = await self._resolve(discord_id, channel_id)
+        if channel is None:
+            logging.warning("can't find channel {} to alert {}".format(channel_id, discord_id))
+            return
+
+        q = self._queues.get(channel.id)
+        if q is None:
+            q = self._queues[channel.id] = destination_queue(channel, token_bucket(self._rate, self._burst))
+        q.messages.extend(format_alert(user.mention, a) for a in alerts)
+        if q.task is None or q.task.done():
+            q.task = asyncio.ensure_future(self._drain(q))
+
+    async def _drain(self, q):
+        # give a burst of alerts a moment to arrive so they can share a message
+        await asyncio.sleep(self._delay)
+        while len(q.messages) > 0:
+            content, embeds = [], []
+            length = 0
+            while len(q.messages) > 0 and len(embeds) < max_embeds_per_message and length + len(q.messages[0][0]) + 1 <= max_message_length:
+                msg, embed = q.messages.popleft()
+                content.append(msg)
+                embeds.append(embed)
+                length += len(msg) + 1
+            if len(embeds) == 0: # a single message over the limit; send it anyway and let discord complain
+                msg, embed = q.messages.popleft()
+                content.append(msg)
+                embeds.append(embed)
+
+            await q.bucket.acquire()
+            try:
+                async with self._ctx.discord_limit:
+                    await self._send(q.channel, "\n".join(content), embeds)
+                alerts_sent.inc('sent', n=len(embeds))
+            except Exception as e:
+                alerts_sent.inc('failed', n=len(embeds))
+                logging.warning("failed to deliver {:d} alerts to channel {}".format(len(embeds), q.channel.id))
+                logging.exception(e)
+
+    async def _send(self, channel, content, embeds):
+        # discord.py 1.7 can only attach one embed through send(), so post
+        # the message directly; its http client still applies the per-route
+        # rate limit buckets for us
+        route = Route('POST', '/channels/{channel_id}/messages', channel_id=channel.id)
+        try:
+            with request_duration.time('discord_message'):
+                await self._ctx.http.request(route, json={
+                    'content': content,
+                    'embeds': [embed.to_dict() for embed in embeds]
+                })
+        except Exception:
+            requests_total.inc('discord_message', 'error')
+            raise
+        requests_total.inc('discord_message', 'ok')
@@ -0,0 +1,139 @@
+import asyncio
+import logging
+from .csgo_client import csgo_client
+
+__all__ = ['gc_pool']
+
+class gc_session (object):
+    __slots__ = ('name', 'client', 'ready', 'in_flight', 'failures')
+
+    def __init__(self, name, client):
+        self.name = name
+        self.client = client
+        self.ready = False
+        self.in_flight = 0
+        self.failures = 0
+
+
+class gc_pool (object):
+    def __init__(self, bridge, config, shard_id=0, shard_count=1):
+        self._bridge = bridge
+        self._chunk_size = config.getint('gc_max_in_flight', 8)
+        self._max_failures = config.getint('gc_max_failures', 3)
+        # how long a request waits for any session to come up before giving
+        # up on this round
+        self._ready_timeout = config.getfloat('gc_reconnect_timeout', 30)
+        self._sessions = []
+        accounts = self.parse_accounts(config, shard_id, shard_count)
+        # with a single session there's nothing to fail over to, so wait out
+        # reconnects; otherwise give up quickly and let another session retry
+        if len(accounts) == 1:
+            reconnect_timeout = config.getfloat('gc_reconnect_timeout', 30)
+        else:
+            reconnect_timeout = config.getfloat('gc_failover_timeout', 2)
+        for username, password in accounts:
+            # clients have to be created on the bridge's hub
+            client = bridge.run(csgo_client, config, username, password, reconnect_timeout)
+            self._sessions.append(gc_session(username, client))
+        self._ready = asyncio.Event()
+
+    @staticmethod
+    def parse_accounts(config, shard_id=0, shard_count=1):
+        # steam_bot_accounts holds one username:password per line; otherwise
+        # fall back to the single steam_bot_username/steam_bot_password. steam
+        # allows one session per account, so with poll workers account i
+        # belongs to shard i % shard_count only
+        accounts = []
+        for line in config.get('steam_bot_accounts', '').splitlines():
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            username, password = line.split(':', 1)
+            accounts.append((username, password))
+        if len(accounts) == 0:
+            accounts.append((config['steam_bot_username'], config['steam_bot_password']))
+        accounts = accounts[shard_id::shard_count]
+        if len(accounts) == 0:
+            raise ValueError("no steam bot accounts for shard {:d} of {:d}; steam_bot_accounts needs at least one per shard".format(shard_id, shard_count))
+        return accounts
+
+    def __len__(self):
+        return len(self._sessions)
+
+    async def start(self):
+        loop = asyncio.get_event_loop()
+        for session in self._sessions:
+            session.client.add_status_listener(lambda ready, session=session: loop.call_soon_threadsafe(self._set_ready, session, ready))
+        # one at a time, since logging in may prompt for a 2fa code; an
+        # account whose gc session is slow to come up doesn't hold up the rest
+        for session in self._sessions:
+            try:
+                await self._bridge.call(session.client.login)
+            except ValueError as e:
+                logging.warning("gc session for {} not up yet: {}".format(session.name, e))
+            except Exception as e:
+                logging.error("failed to log in to steam as {}".format(session.name))
+                logging.exception(e)
+
+    def _set_ready(self, session, ready):
+        session.ready = ready
+        if ready:
+            session.failures = 0
+        if any(s.ready for s in self._sessions):
+            self._ready.set()
+        else:
+            self._ready.clear()
+
+    async def wait_ready(self):
+        await self._ready.wait()
+
+    def _pick(self):
+        # least loaded healthy session, falling back to unhealthy ones
+        ready = [s for s in self._sessions if s.ready]
+        if len(ready) == 0:
+            return None
+        return min(ready, key=lambda s: (s.failures >= self._max_failures, s.in_flight))
+
+    async def _dispatch(self, items):
+        session = self._pick()
+        if session is None:
+            try:
+                await asyncio.wait_for(self.wait_ready(), self._ready_timeout)
+            except asyncio.TimeoutError:
+                logging.info("no gc session ready after {:g}s".format(self._ready_timeout))
+                return None
+            session = self._pick()
+            if session is None:
+                return None
+
+        session.in_flight += len(items)
+        try:
+            res = await self._bridge.call(session.client.get_item_killcounts, items)
+        except ValueError as e:
+            logging.info("gc session {} failed: {}".format(session.name, e))
+            session.failures += 1
+            return None
+        finally:
+            session.in_flight -= len(items)
+
+        if len(res) < len(items):
+            session.failures += 1
+        else:
+            session.failures = 0
+        return res
+
+    async def get_item_killcounts(self, items):
+        # spread the batch over the sessions; items a session fails to answer
+        # are left out, and will land on a different session when retried. if
+        # no chunk got through at all the gc is down, which callers need to
+        # tell apart from items it doesn't answer for
+        items = list(items)
+        chunks = [items[i:i+self._chunk_size] for i in range(0, len(items), self._chunk_size)]
+        results = await asyncio.gather(*(self._dispatch(chunk) for chunk in chunks))
+        if len(results) > 0 and all(r is None for r in results):
+            raise ValueError("no gc session answered")
+        res = {}
+        for r in results:
+            if r is not None:
+                res.update(r)
+        return res
@@ -0,0 +1,95 @@
+from collections import deque
+from gevent import monkey
+import asyncio
+import gevent
+import gevent.event
+
+__all__ = ['gevent_bridge']
+
+# the threading module is monkey patched into greenlets, so the bridge's own
+# thread and the locks used to hand results across have to be the originals
+_start_new_thread = monkey.get_original('_thread', 'start_new_thread')
+_allocate_lock = monkey.get_original('_thread', 'allocate_lock')
+
+
+class gevent_bridge (object):
+    # runs a gevent hub in a dedicated os thread; calls submitted from other
+    # threads are run as greenlets on that hub
+
+    def __init__(self):
+        self._jobs = deque()
+        self._started = _allocate_lock()
+
+    def start(self):
+        self._started.acquire()
+        _start_new_thread(self._run, ())
+        # released by the bridge thread once its hub is up
+        self._started.acquire()
+        self._started.release()
+
+    def _run(self):
+        hub = gevent.get_hub()
+        self._wakeup = hub.loop.async_()
+        self._wakeup.start(self._drain)
+        self._stop = gevent.event.Event()
+        self._started.release()
+        self._stop.wait()
+
+    def _drain(self):
+        while len(self._jobs) > 0:
+            fn, args, done = self._jobs.popleft()
+            gevent.spawn(self._execute, fn, args, done)
+
+    def _execute(self, fn, args, done):
+        try:
+            res = fn(*args)
+        except gevent.GreenletExit:
+            raise
+        except BaseException as e:
+            done(None, e)
+        else:
+            done(res, None)
+
+    def _post(self, fn, args, done):
+        # done(result, exception) is called on the bridge thread
+        self._jobs.append((fn, args, done))
+        self._wakeup.send()
+
+    def run(self, fn, *args):
+        # blocks the calling thread until fn has run on the bridge's hub
+        lock = _allocate_lock()
+        lock.acquire()
+        res = []
+
+        def done(value, error):
+            res.extend((value, error))
+            lock.release()
+
+        self._post(fn, args, done)
+        lock.acquire()
+        value, error = res
+        if error is not None:
+            raise error
+        return value
+
+    async def call(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+
+        def done(value, error):
+            loop.call_soon_threadsafe(self._resolve, fut, value, error)
+
+        self._post(fn, args, done)
+        return await fut
+
+    @staticmethod
+    def _resolve(fut, value, error):
+        if fut.cancelled():
+            return
+        if error is not None:
+            fut.set_exception(error)
+        else:
+            fut.set_result(value)
+
+    def stop(self):
+        self._post(self._stop.set, (), lambda value, error: None)
@@ -0,0 +1,82 @@
+import aiohttp
+import asyncio
+import json
+import logging
+
+__all__ = ['http_client', 'http_response']
+
+class http_response (object):
+    __slots__ = ('status_code', 'retry_after', '_data')
+
+    def __init__(self, status_code, data, retry_after=None):
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self._data = data
+
+    def json(self):
+        return self._data
+
+
+class http_client (object):
+
+    # 429 and 503 are rate limiting, which is left to the caller to handle
+    _retry_statuses = (500, 502, 504)
+
+    def __init__(self, pool_size=8, timeout=10, retries=3, backoff=0.5, keepalive=60):
+        self._pool_size = pool_size
+        self._timeout = timeout
+        self._retries = retries
+        self._backoff = backoff
+        self._keepalive = keepalive
+        self._session = None
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            pool_size=config.getint('http_pool_size', 8),
+            timeout=config.getfloat('http_timeout', 10),
+            retries=config.getint('http_retries', 3),
+            backoff=config.getfloat('http_backoff', 0.5)
+        )
+
+    def _get_session(self):
+        # created lazily so that it binds to the running event loop
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self._pool_size, keepalive_timeout=self._keepalive),
+                timeout=aiohttp.ClientTimeout(total=self._timeout)
+            )
+        return self._session
+
+    async def _get_once(self, url):
+        async with self._get_session().get(url) as r:
+            body = await r.read()
+            try:
+                data = json.loads(body)
+            except ValueError:
+                data = None
+            try:
+                retry_after = float(r.headers.get('Retry-After'))
+            except (TypeError, ValueError):
+                retry_after = None
+            return http_response(r.status, data, retry_after)
+
+    async def get(self, url):
+        attempt = 0
+        while True:
+            try:
+                res = await self._get_once(url)
+                if not res.status_code in self._retry_statuses or attempt >= self._retries:
+                    return res
+                logging.info("got status {:d} from {}, retrying...".format(res.status_code, url.split('?')[0]))
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt >= self._retries:
+                    raise
+                logging.info("request to {} failed ({}), retrying...".format(url.split('?')[0], type(e).__name__))
+            await asyncio.sleep(self._backoff * 2 ** attempt)
+            attempt += 1
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
@@ -1,4 +1,5 @@
-# have to monkeypatch as early as possible
+# have to monkeypatch as early as possible; the steam client's thread is
+# started with the unpatched primitives (see gevent_bridge)
 import gevent
 from gevent import monkey
 monkey.patch_all()
@@ -8,7 +9,11 @@ from .commands import process_command
 from .database import fmdb
 from .steam_utils import steamapi
 from .async_utils import recurring_task
+from .scheduler import poll_scheduler
 from .update import do_update
+from .delivery import alert_dispatcher
+from .shard import shard_server, poll_worker
+from .metrics import metrics_server, registry
 from . import emoji
 
 import argparse
@@ -19,20 +24,56 @@ import logging
 
 logging.basicConfig(level=logging.INFO)
 
-class fragminder (discord.Client):
+class fragminder (discord.AutoShardedClient):
     def __init__(self, config):
-        super().__init__()
+        super().__init__(shard_count=config.getint('discord_shard_count', None))
         self.conf = config
         self.ready = False
         self.steam = steamapi(self.conf)
+        self.discord_limit = asyncio.Semaphore(self.conf.getint('discord_concurrency', 4))
+        self.scheduler = poll_scheduler.from_config(self.conf)
+        self.dispatcher = alert_dispatcher(self, self.conf)
 
     async def on_ready(self):
         loop = asyncio.get_event_loop()
         if not self.ready:
-            self.db = await fmdb.open(self.conf['database_file'])
-            self._user_poller = recurring_task(float(self.conf['user_poll_interval']), do_update, self)
+            self.db = await fmdb.open(self.conf['database_file'], readers=self.conf.getint('database_readers', 2), cache_size=self.conf.getint('database_cache_size', 8192), lookup_cache_size=self.conf.getint('lookup_cache_size', 4096))
+            self.steam.attach_db(self.db)
             self.ready = True
-            await self._user_poller.start()
+            if self.conf.getint('metrics_port', None) is not None:
+                self._metrics = metrics_server(registry)
+                await self._metrics.start(self.conf.get('metrics_address', '127.0.0.1'), self.conf.getint('metrics_port'))
+            if self.conf.getint('shard_count', 1) > 1:
+                # polling is done by separate poll worker processes
+                self._shard_server = shard_server(self)
+                await self._shard_server.start(self.conf['shard_server_address'])
+            else:
+                self._user_poller = recurring_task(self.conf.getfloat('poll_tick', 5), do_update, self, jitter=self.conf.getfloat('poll_tick_jitter', 0.5))
+                self._steam_login = asyncio.ensure_future(self.steam.start())
+                await self._user_poller.start()
+
+    async def send_alerts(self, discord_id, channel_id, alerts):
+        await self.dispatcher.send(discord_id, channel_id, alerts)
+
+    # keep the alert destination cache in step with the gateway
+    async def on_user_update(self, before, after):
+        self.dispatcher.destinations.invalidate_user(after.id)
+
+    async def on_member_update(self, before, after):
+        self.dispatcher.destinations.invalidate_user(after.id)
+
+    async def on_member_remove(self, member):
+        self.dispatcher.destinations.invalidate_user(member.id)
+
+    async def on_guild_channel_update(self, before, after):
+        self.dispatcher.destinations.invalidate_channel(after.id)
+
+    async def on_guild_channel_delete(self, channel):
+        self.dispatcher.destinations.invalidate_channel(channel.id)
+
+    async def on_guild_remove(self, guild):
+        for channel in guild.channels:
+            self.dispatcher.destinations.invalidate_channel(channel.id)
     
     async def on_message(self, message):
         if not self.ready: # ignore messages received before we're ready
@@ -56,17 +97,27 @@ class fragminder (discord.Client):
             if 'react' in result:
                 await message.add_reaction(result['react'])
 
+    async def close(self):
+        await self.steam.close()
+        if self.ready:
+            await self.db.close()
+        await super().close()
+
     def run(self):
         super().run(self.conf['discord_token'])
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('config_file')
+    parser.add_argument('--worker', metavar='SHARD_ID', type=int, help='run as the poll worker for the given shard')
 
     args = parser.parse_args()
 
     config = configparser.ConfigParser()
     config.read(args.config_file)
 
-    bot = fragminder(config['fragminder'])
-    bot.run()
+    if args.worker is not None:
+        poll_worker(config['fragminder'], args.worker).run()
+    else:
+        bot = fragminder(config['fragminder'])
+        bot.run()
@@ -0,0 +1,180 @@
+from aiohttp import web
+from bisect import bisect_left
+import functools
+import logging
+import time
+
+__all__ = ['registry', 'metrics_server', 'timed', 'cycle_duration', 'stage_duration', 'request_duration', 'requests_total', 'gc_retries', 'gc_unanswered', 'db_duration', 'alerts_sent']
+
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if len(pairs) == 0:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join('{}="{}"'.format(k, v) for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class counter (object):
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+
+    def inc(self, *labels, n=1):
+        self._values[labels] = self._values.get(labels, 0) + n
+
+    def render(self):
+        yield '# HELP {} {}'.format(self.name, self.help)
+        yield '# TYPE {} counter'.format(self.name)
+        for labels, value in sorted(self._values.items()):
+            yield '{}{} {}'.format(self.name, format_labels(self.labels, labels), format_value(value))
+
+    def summary(self):
+        for labels, value in sorted(self._values.items()):
+            yield '{}{}: {}'.format(self.name, format_labels(self.labels, labels), format_value(value))
+
+
+class histogram_timer (object):
+    __slots__ = ('_histogram', '_labels', '_started')
+
+    def __init__(self, histogram, labels):
+        self._histogram = histogram
+        self._labels = labels
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._histogram.observe(time.perf_counter() - self._started, *self._labels)
+
+
+class histogram (object):
+    # per label set: [bucket counts..., count above the last bucket], sum
+    def __init__(self, name, help, labels=(), buckets=default_buckets):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._buckets = tuple(buckets)
+        self._values = {}
+
+    def observe(self, value, *labels):
+        entry = self._values.get(labels)
+        if entry is None:
+            entry = self._values[labels] = [[0] * (len(self._buckets) + 1), 0]
+        entry[0][bisect_left(self._buckets, value)] += 1
+        entry[1] += value
+
+    def time(self, *labels):
+        return histogram_timer(self, labels)
+
+    def render(self):
+        yield '# HELP {} {}'.format(self.name, self.help)
+        yield '# TYPE {} histogram'.format(self.name)
+        for labels, (counts, total) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, n in zip(self._buckets + (float('inf'),), counts):
+                cumulative += n
+                yield '{}_bucket{} {:d}'.format(self.name, format_labels(self.labels, labels, [('le', format_value(float(bound)))]), cumulative)
+            yield '{}_sum{} {}'.format(self.name, format_labels(self.labels, labels), format_value(float(total)))
+            yield '{}_count{} {:d}'.format(self.name, format_labels(self.labels, labels), cumulative)
+
+    def _quantile(self, counts, q):
+        # upper bound of the bucket the quantile falls in
+        target = q * sum(counts)
+        cumulative = 0
+        for bound, n in zip(self._buckets + (float('inf'),), counts):
+            cumulative += n
+            if cumulative >= target:
+                return bound
+        return float('inf')
+
+    def summary(self):
+        for labels, (counts, total) in sorted(self._values.items()):
+            n = sum(counts)
+            p95 = self._quantile(counts, 0.95)
+            yield '{}{}: n={:d} mean={:.3g} p95{}'.format(
+                self.name, format_labels(self.labels, labels), n, total / n,
+                '<={:g}'.format(p95) if p95 != float('inf') else '>{:g}'.format(self._buckets[-1])
+            )
+
+
+class metric_registry (object):
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, help, labels=()):
+        m = counter(name, help, labels)
+        self._metrics.append(m)
+        return m
+
+    def histogram(self, name, help, labels=(), buckets=default_buckets):
+        m = histogram(name, help, labels, buckets)
+        self._metrics.append(m)
+        return m
+
+    def render(self):
+        return '\n'.join(line for m in self._metrics for line in m.render()) + '\n'
+
+    def summary(self):
+        return [line for m in self._metrics for line in m.summary()]
+
+
+registry = metric_registry()
+
+cycle_duration = registry.histogram('fragminder_poll_cycle_seconds', 'duration of a whole poll cycle')
+stage_duration = registry.histogram('fragminder_poll_stage_seconds', 'time spent in each stage of polling a player', ('stage',))
+request_duration = registry.histogram('fragminder_request_seconds', 'latency of requests to steam, the gc and discord', ('endpoint',))
+requests_total = registry.counter('fragminder_requests_total', 'requests to steam, the gc and discord', ('endpoint', 'status'))
+gc_retries = registry.histogram('fragminder_gc_retries', 'retry rounds needed to get every killcount for a player', buckets=(0, 1, 2, 3, 4, 5))
+gc_unanswered = registry.counter('fragminder_gc_unanswered_total', 'items the gc never answered for, after every retry')
+db_duration = registry.histogram('fragminder_db_seconds', 'time spent in database calls', ('op',))
+alerts_sent = registry.counter('fragminder_alerts_total', 'alerts handed to discord', ('status',))
+
+
+def timed(histogram, *labels):
+    # times every call of a coroutine function
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with histogram.time(*labels):
+                return await fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class metrics_server (object):
+    # serves the registry in prometheus' text format; meant to be bound to a
+    # local address and scraped from the same host
+
+    def __init__(self, registry):
+        self._registry = registry
+        self._runner = None
+
+    async def _handle(self, request):
+        return web.Response(body=self._registry.render().encode(), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+    async def start(self, host, port):
+        app = web.Application()
+        app.router.add_get('/metrics', self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logging.info("serving metrics on {}:{:d}".format(host, port))
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
@@ -0,0 +1,66 @@
+import asyncio
+import logging
+import time
+from collections import Counter
+
+__all__ = ['token_bucket', 'rate_limiter']
+
+class token_bucket (object):
+    def __init__(self, rate, burst):
+        self._rate = rate
+        self._burst = burst
+        self._tokens = burst
+        self._last = time.monotonic()
+        self._blocked_until = 0
+
+    def _refill(self, now):
+        self._tokens = min(self._burst, self._tokens + (now - self._last) * self._rate)
+        self._last = now
+
+    async def acquire(self, n=1):
+        # tokens are reserved up front and may go negative, so callers queue up
+        # behind each other and a batch larger than the burst size still works
+        now = time.monotonic()
+        self._refill(now)
+        self._tokens -= n
+        wait = max(self._blocked_until - now, -self._tokens / self._rate)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def block(self, delay):
+        self._blocked_until = max(self._blocked_until, time.monotonic() + delay)
+
+
+class rate_limiter (object):
+    def __init__(self, buckets, endpoints):
+        # buckets: {bucket_name: token_bucket}, endpoints: {endpoint: bucket_name}
+        self._buckets = buckets
+        self._endpoints = endpoints
+        self.requests = Counter()
+        self.throttled = Counter()
+
+    @classmethod
+    def from_config(cls, config, gc_sessions=1, shard_count=1):
+        # gc limits are per bot account; the web api and community limits are
+        # for the whole api key and ip, so poll workers split them evenly
+        return cls({
+            'webapi': token_bucket(config.getfloat('steam_api_rate', 1) / shard_count, max(1, config.getint('steam_api_burst', 20) // shard_count)),
+            'community': token_bucket(config.getfloat('steam_community_rate', 0.2) / shard_count, max(1, config.getint('steam_community_burst', 5) // shard_count)),
+            'gc': token_bucket(config.getfloat('gc_rate', 5) * gc_sessions, config.getint('gc_burst', 20) * gc_sessions)
+        }, {
+            'GetPlayerSummaries': 'webapi',
+            'ResolveVanityURL': 'webapi',
+            'GetAssetClassInfo': 'webapi',
+            'inventory': 'community',
+            'gc_preview': 'gc'
+        })
+
+    async def acquire(self, endpoint, n=1):
+        self.requests[endpoint] += n
+        await self._buckets[self._endpoints[endpoint]].acquire(n)
+
+    def throttle(self, endpoint, delay):
+        # steam told us to slow down; hold off everything sharing this bucket
+        logging.warning("throttled on {}, backing off for {:.1f}s".format(endpoint, delay))
+        self.throttled[endpoint] += 1
+        self._buckets[self._endpoints[endpoint]].block(delay)
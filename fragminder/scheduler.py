@@ -0,0 +1,58 @@
+import random
+import time
+
+__all__ = ['poll_scheduler']
+
+class poll_scheduler (object):
+    def __init__(self, min_interval, max_interval, near_distance, budget=0, jitter=0.1):
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._near_distance = near_distance
+        self._budget = budget
+        self._jitter = jitter
+        self._next_poll = {}
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            min_interval=config.getfloat('poll_min_interval', 5),
+            max_interval=float(config['user_poll_interval']),
+            near_distance=config.getint('poll_near_distance', 5),
+            budget=config.getint('poll_budget', 0),
+            jitter=config.getfloat('poll_jitter', 0.1)
+        )
+
+    def interval(self, distance):
+        # players close to a watch get polled quickly, everyone else is backed
+        # off in proportion to how many kills they still need
+        if distance is None:
+            return self._max_interval
+        if distance <= self._near_distance:
+            return self._min_interval
+        return min(self._max_interval, self._min_interval * distance / self._near_distance)
+
+    def due(self, steam_ids, now=None):
+        if now is None:
+            now = time.monotonic()
+
+        # forget players who no longer have any watches
+        steam_ids = set(steam_ids)
+        for steam_id in list(self._next_poll.keys()):
+            if not steam_id in steam_ids:
+                del self._next_poll[steam_id]
+
+        # players we haven't seen yet are due immediately
+        due = [(self._next_poll.get(steam_id, 0), steam_id) for steam_id in steam_ids]
+        due = [(t, steam_id) for t, steam_id in due if t <= now]
+
+        # most overdue first, limited to the per-cycle budget
+        due.sort()
+        if self._budget > 0:
+            due = due[:self._budget]
+        return [steam_id for _, steam_id in due]
+
+    def schedule(self, steam_id, distance=None, now=None):
+        if now is None:
+            now = time.monotonic()
+        interval = self.interval(distance) * random.uniform(1 - self._jitter, 1 + self._jitter)
+        self._next_poll[steam_id] = now + interval
@@ -0,0 +1,204 @@
+from .async_utils import recurring_task
+from .database import poll_batch
+from .metrics import metrics_server, registry
+from .scheduler import poll_scheduler
+from .steam_utils import steamapi
+from .update import do_update
+from .watch_index import watch_index
+import asyncio
+import json
+import logging
+
+__all__ = ['shard_server', 'poll_worker']
+
+# large enough for a full export of the watch index on one line
+max_message_size = 2 ** 26
+
+
+def parse_address(address):
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+async def write_message(writer, lock, message):
+    async with lock:
+        writer.write(json.dumps(message).encode() + b'\n')
+        await writer.drain()
+
+
+class shard_server (object):
+    # runs in the discord-facing process; poll workers fetch their partition
+    # of the database from it and hand back writes and alerts
+
+    def __init__(self, ctx):
+        self._ctx = ctx
+        self._server = None
+        self._handlers = {
+            'watch_index': self._watch_index,
+            'write_batch': self._write_batch,
+            'get_class_infos': self._get_class_infos,
+            'add_class_infos': self._add_class_infos,
+            'send_alerts': self._send_alerts
+        }
+
+    async def start(self, address):
+        host, port = parse_address(address)
+        self._server = await asyncio.start_server(self._handle, host, port, limit=max_message_size)
+        logging.info("listening for poll workers on {}".format(address))
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        lock = asyncio.Lock()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                asyncio.ensure_future(self._respond(writer, lock, json.loads(line)))
+        finally:
+            writer.close()
+
+    async def _respond(self, writer, lock, message):
+        try:
+            reply = {'id': message['id'], 'result': await self._handlers[message['op']](**message['args'])}
+        except Exception as e:
+            logging.error("failed to handle {} from poll worker".format(message.get('op')))
+            logging.exception(e)
+            reply = {'id': message['id'], 'error': str(e)}
+        await write_message(writer, lock, reply)
+
+    async def _watch_index(self, shard_id, shard_count, version):
+        # workers keep their own copy of the index, so only send it when it
+        # has changed since they last fetched it
+        index = await self._ctx.db.watch_index()
+        if version == index.version:
+            return {'version': version, 'users': None}
+        return {'version': index.version, 'users': index.export(shard_id, shard_count)}
+
+    async def _write_batch(self, weapon_updates, removed_watches, relinked_weapons, killcounts):
+        await self._ctx.db.write_batch(weapon_updates, removed_watches, relinked_weapons, killcounts)
+
+    async def _get_class_infos(self, keys):
+        return list((await self._ctx.db.get_class_infos(map(tuple, keys))).items())
+
+    async def _add_class_infos(self, infos):
+        await self._ctx.db.add_class_infos({tuple(key): tuple(info) for key, info in infos})
+
+    async def _send_alerts(self, discord_id, channel_id, alerts):
+        await self._ctx.send_alerts(discord_id, channel_id, alerts)
+
+
+class shard_client (object):
+    def __init__(self, address):
+        self._address = address
+        self._writer = None
+        self._lock = asyncio.Lock()
+        self._pending = {}
+        self._next_id = 0
+
+    async def _connect(self):
+        host, port = parse_address(self._address)
+        reader, self._writer = await asyncio.open_connection(host, port, limit=max_message_size)
+        asyncio.ensure_future(self._read(reader, self._writer))
+
+    async def _read(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                fut = self._pending.pop(message['id'], None)
+                if fut is None or fut.done():
+                    continue
+                if 'error' in message:
+                    fut.set_exception(RuntimeError("shard server: {}".format(message['error'])))
+                else:
+                    fut.set_result(message['result'])
+        finally:
+            logging.warning("lost connection to shard server")
+            if self._writer is writer:
+                self._writer = None
+            for fut in self._pending.values():
+                if not fut.done():
+                    fut.set_exception(ConnectionError("lost connection to shard server"))
+            self._pending.clear()
+
+    async def request(self, op, **args):
+        async with self._lock:
+            if self._writer is None:
+                await self._connect()
+        self._next_id += 1
+        fut = self._pending[self._next_id] = asyncio.get_event_loop().create_future()
+        await write_message(self._writer, self._lock, {'id': self._next_id, 'op': op, 'args': args})
+        return await fut
+
+
+class remote_db (object):
+    # the subset of fmdb used by the poller, forwarded to the shard server
+
+    def __init__(self, client, shard_id, shard_count):
+        self._client = client
+        self._shard_id = shard_id
+        self._shard_count = shard_count
+        self._index = None
+
+    async def watch_index(self):
+        version = self._index.version if self._index is not None else None
+        res = await self._client.request('watch_index', shard_id=self._shard_id, shard_count=self._shard_count, version=version)
+        if res['users'] is not None:
+            self._index = watch_index.from_export(res['version'], res['users'])
+        return self._index
+
+    def batch(self):
+        return poll_batch(self)
+
+    async def write_batch(self, weapon_updates, removed_watches, relinked_weapons, killcounts):
+        await self._client.request('write_batch', weapon_updates=weapon_updates, removed_watches=removed_watches, relinked_weapons=relinked_weapons, killcounts=killcounts)
+        # keep our copy in step without fetching it again
+        if self._index is not None:
+            version = self._index.version
+            self._index.apply_batch(weapon_updates, removed_watches, relinked_weapons)
+            self._index.version = version
+
+    async def get_class_infos(self, keys):
+        res = await self._client.request('get_class_infos', keys=list(keys))
+        return {tuple(key): tuple(info) for key, info in res}
+
+    async def add_class_infos(self, infos):
+        await self._client.request('add_class_infos', infos=list(infos.items()))
+
+
+class poll_worker (object):
+    # a standalone poller for one shard of the steam ids, without a discord
+    # client or database of its own
+
+    def __init__(self, config, shard_id):
+        self.conf = config
+        shard_count = self.conf.getint('shard_count')
+        # only this shard's bot accounts, and its share of the api rates
+        self.steam = steamapi(self.conf, shard_id, shard_count)
+        self.scheduler = poll_scheduler.from_config(self.conf)
+        self._client = shard_client(self.conf['shard_server_address'])
+        self._shard_id = shard_id
+        self.db = remote_db(self._client, shard_id, shard_count)
+        self.steam.attach_db(self.db)
+
+    async def send_alerts(self, discord_id, channel_id, alerts):
+        await self._client.request('send_alerts', discord_id=discord_id, channel_id=channel_id, alerts=alerts)
+
+    async def _run(self):
+        if self.conf.getint('metrics_port', None) is not None:
+            # each worker has its own metrics, on the ports after the main process'
+            self._metrics = metrics_server(registry)
+            await self._metrics.start(self.conf.get('metrics_address', '127.0.0.1'), self.conf.getint('metrics_port') + 1 + self._shard_id)
+        self._steam_login = asyncio.ensure_future(self.steam.start())
+        self._user_poller = recurring_task(self.conf.getfloat('poll_tick', 5), do_update, self, jitter=self.conf.getfloat('poll_tick_jitter', 0.5))
+        await self._user_poller.start()
+        await asyncio.Event().wait()
+
+    def run(self):
+        asyncio.get_event_loop().run_until_complete(self._run())
@@ -1,35 +1,107 @@
 import asyncio
-import requests
 import urllib.parse
 import re
 import logging
-from .csgo_client import csgo_client
+import time
+from .gc_pool import gc_pool
+from .gevent_bridge import gevent_bridge
+from .cache_utils import lru_dict
+from .http_utils import http_client
+from .metrics import request_duration, requests_total, gc_retries, gc_unanswered
+from .ratelimit import rate_limiter
 
 __all__ = ['steamapi']
 
+class inventory_index (object):
+    def __init__(self):
+        self.assets = {} # asset_id -> (class_id, instance_id)
+        self.cursor = None # start_assetid of the next page to fetch
+        self.complete = False
+        self.created = time.monotonic()
+        self.lock = asyncio.Lock()
+
+
 class steamapi(object):
 
     _gameid = 730
     _inspect_url_regex = re.compile('^steam://rungame/730/.*S([0-9]+)A([0-9]+)D([0-9]+)$')
     _invent_link_regex = re.compile('^(https://steamcommunity.com/id/[^/]+)/inventory/#730_2_([0-9]+)$')
 
-    def __init__(self, config):
+    def __init__(self, config, shard_id=0, shard_count=1):
         self._key = config['steam_api_key']
         self._config = config
-        self._client = csgo_client(config)
-        
+        self._api_url = config.get('steam_api_url', 'https://api.steampowered.com')
+        self._community_url = config.get('steam_community_url', 'https://steamcommunity.com')
+        self._http = http_client.from_config(config)
+        self._limiter = rate_limiter.from_config(config, len(gc_pool.parse_accounts(config, shard_id, shard_count)), shard_count)
+        self._throttle_retries = config.getint('steam_throttle_retries', 3)
+        self._throttle_backoff = config.getfloat('steam_throttle_backoff', 10)
+        # the steam client and everything gevent lives on the bridge's hub
+        self._bridge = gevent_bridge()
+        self._bridge.start()
+        self._gc = gc_pool(self._bridge, config, shard_id, shard_count)
+        self._api_limit = asyncio.Semaphore(config.getint('steam_api_concurrency', 4))
+        # per bot account, like the gc rate limit, so throughput grows with the pool
+        self._gc_limit = asyncio.Semaphore(config.getint('gc_concurrency', 4) * len(self._gc))
+        self._class_info = lru_dict(config.getint('class_info_cache_size', 4096))
+        self._inventories = lru_dict(config.getint('inventory_cache_size', 256))
+        self._inventory_ttl = config.getfloat('inventory_cache_ttl', 300)
+        self._gone_assets = lru_dict(config.getint('inventory_cache_size', 256))
+        # asset -> consecutive lookups the gc didn't answer although it was up.
+        # the gc silently drops requests, and doesn't answer for assets that
+        # no longer exist either, so an asset is only looked for under a new
+        # id once it has gone unanswered for relink_after_cycles lookups
+        self._unanswered = {}
+        self._relink_after = config.getint('relink_after_cycles', 3)
+        self._db = None
+
+    def attach_db(self, db):
+        self._db = db
+
+    async def start(self):
+        # bring up the steam/gc sessions in the background; anything that needs
+        # the gc should wait_ready() first
+        await self._gc.start()
+
+    async def wait_ready(self):
+        await self._gc.wait_ready()
+
+    async def _get(self, endpoint, url):
+        attempt = 0
+        while True:
+            await self._limiter.acquire(endpoint)
+            async with self._api_limit:
+                try:
+                    with request_duration.time(endpoint):
+                        r = await self._http.get(url)
+                except Exception:
+                    requests_total.inc(endpoint, 'error')
+                    raise
+            requests_total.inc(endpoint, str(r.status_code))
+            if not r.status_code in (429, 503) or attempt >= self._throttle_retries:
+                return r
+            self._limiter.throttle(endpoint, r.retry_after or self._throttle_backoff * 2 ** attempt)
+            attempt += 1
+
+    def request_counts(self):
+        return dict(self._limiter.requests), dict(self._limiter.throttled)
+
+    async def close(self):
+        await self._http.close()
+        self._bridge.stop()
+
     def _build_inventory_url(self, user_id, last_assetid=None):
         page_limit = 1000
-        url = 'https://steamcommunity.com/inventory/{:d}/{:d}/2?l=english&count={:d}'.format(user_id, self._gameid, page_limit)
+        url = '{}/inventory/{:d}/{:d}/2?l=english&count={:d}'.format(self._community_url, user_id, self._gameid, page_limit)
         if last_assetid:
             url += '&start_assetid={}'.format(last_assetid)
         return url
 
     def _build_summaries_url(self, user_ids):
-        return 'http://api.steampowered.com/ISteamUser/GetPlayerSummaries/v0002/?key={}&steamids={}&format=json'.format(self._key, ";".join(map(str, user_ids)))
+        return '{}/ISteamUser/GetPlayerSummaries/v0002/?key={}&steamids={}&format=json'.format(self._api_url, self._key, ";".join(map(str, user_ids)))
 
     def _build_resolve_url(self, vanityurl):
-        return 'https://api.steampowered.com/ISteamUser/ResolveVanityURL/v1/?key={}&vanityurl={}&url_type=1'.format(self._key, vanityurl)
+        return '{}/ISteamUser/ResolveVanityURL/v1/?key={}&vanityurl={}&url_type=1'.format(self._api_url, self._key, vanityurl)
 
     def _build_item_preview_url(self, icon):
         return 'https://steamcommunity-a.akamaihd.net/economy/image/{}/330x192'.format(icon)
@@ -37,9 +109,9 @@ class steamapi(object):
     def _build_inspect_url(self, url_template, uid, assetid):
         return url_template.replace('%owner_steamid%', str(uid)).replace('%assetid%', str(assetid))
 
-    def _build_item_info_url(self, tups):
-        item_args = '&'.join("classid{}={}&instanceid{}={}".format(n, c, n, i) for (n, (_, c, i)) in enumerate(tups))
-        return 'https://api.steampowered.com/ISteamEconomy/GetAssetClassInfo/v1/?key={}&appid={}&language=english&class_count={}&{}'.format(self._key, self._gameid, len(tups), item_args)
+    def _build_item_info_url(self, keys):
+        item_args = '&'.join("classid{}={}&instanceid{}={}".format(n, c, n, i) for (n, (c, i)) in enumerate(keys))
+        return '{}/ISteamEconomy/GetAssetClassInfo/v1/?key={}&appid={}&language=english&class_count={}&{}'.format(self._api_url, self._key, self._gameid, len(keys), item_args)
 
     async def parse_inspect_url(self, url):
         match = self._inspect_url_regex.match(url)
@@ -58,93 +130,228 @@ class steamapi(object):
             return await self.resolve_item_tuple(s, a)
         return None, None, None
 
+    async def _get_active_players_batch(self, user_ids):
+        url = self._build_summaries_url(user_ids)
+        r = await self._get('GetPlayerSummaries', url)
+        if not r.status_code == 200: # error
+            raise RuntimeError("failed to fetch active players")
+        data = r.json()
+        res = set()
+        for p in data['response']['players']:
+            if 'gameid' in p and p['gameid'] == str(self._gameid):
+                res.add(int(p['steamid']))
+        return res
+
+    async def iter_active_players(self, user_ids):
+        # yields the set of in-game players from each batch as soon as that
+        # batch's request completes; all batches are requested concurrently
+        user_ids = list(user_ids)
+        max_users_per_request = 100
+        batches = [self._get_active_players_batch(user_ids[i:i+max_users_per_request]) for i in range(0, len(user_ids), max_users_per_request)]
+        for batch in asyncio.as_completed(batches):
+            try:
+                online = await batch
+            except Exception as e: # skip this batch, those players will be retried later
+                logging.warning("failed to fetch active players batch")
+                logging.exception(e)
+                continue
+            yield online
+
     async def get_active_players(self, user_ids):
-        loop = asyncio.get_event_loop()
-        max_users_per_request = 32
-        res = []
-        for i in range(0, len(user_ids), max_users_per_request):
-            user_ids_subset = user_ids[i:i+max_users_per_request]
-            url = self._build_summaries_url(user_ids_subset)
-            r = await loop.run_in_executor(None, requests.get, url)
-            if not r.status_code == 200: # error
-                raise RuntimeError("failed to fetch active players")
-            data = r.json()
-            for p in data['response']['players']:
-                if 'gameid' in p and p['gameid'] == str(self._gameid):
-                    res.append(int(p['steamid']))
+        res = set()
+        async for online in self.iter_active_players(user_ids):
+            res |= online
         return res
 
+    def invalidate_inventory(self, user_id):
+        self._inventories.invalidate(user_id)
+
+    async def get_inventory(self, user_id, asset_id=None):
+        # returns the (possibly cached) inventory index for a user, reading
+        # further pages only until asset_id is found, or to the end if it's None
+        index = self._inventories.get(user_id)
+        if index is None or time.monotonic() - index.created > self._inventory_ttl:
+            index = inventory_index()
+            self._inventories.put(user_id, index)
+
+        async with index.lock:
+            while not index.complete and (asset_id is None or not asset_id in index.assets):
+                url = self._build_inventory_url(user_id, index.cursor)
+                r = await self._get('inventory', url)
+                if not r.status_code == 200: # error
+                    raise RuntimeError("failed to fetch inventory")
+                data = r.json()
+                if data is None or not 'assets' in data: # reached end
+                    logging.info("no data from inventory call")
+                    index.complete = True
+                    break
+                for asset in data["assets"]:
+                    index.assets[int(asset["assetid"])] = int(asset["classid"]), int(asset["instanceid"])
+                if data.get('more_items') and 'last_assetid' in data:
+                    index.cursor = data['last_assetid']
+                else:
+                    index.complete = True
+
+        return index
+
     async def resolve_item_tuple(self, user_id, asset_id):
-        loop = asyncio.get_event_loop()
-        last_asset_id = None
-        while True:
-            url = self._build_inventory_url(user_id, last_asset_id)
-            r = await loop.run_in_executor(None, requests.get, url)
-            if not r.status_code == 200: # error
-                raise RuntimeError("failed to fetch inventory")
-            data = r.json()
-            if not 'assets' in data: # reached end
-                logging.info("no data from inventory call")
-                break
-            for asset in data["assets"]:
-                if int(asset["assetid"]) == asset_id:
-                    return asset_id, int(asset["classid"]), int(asset["instanceid"])
+        started = time.monotonic()
+        index = await self.get_inventory(user_id, asset_id)
+        if not asset_id in index.assets and index.created < started:
+            # the cached copy may predate the item, so check a fresh one
+            self.invalidate_inventory(user_id)
+            index = await self.get_inventory(user_id, asset_id)
+        if asset_id in index.assets:
+            return (asset_id,) + index.assets[asset_id]
         return None, None, None
 
-    async def get_items_info(self, user_id, item_tuples):
-        loop = asyncio.get_event_loop()
-        last_asset_id = None
+    def _is_gone(self, key):
+        gone_at = self._gone_assets.get(key)
+        return gone_at is not None and time.monotonic() - gone_at < self._inventory_ttl
+
+    async def relink_assets(self, user_id, missing, tracked_asset_ids):
+        # trades, storage units and moves give an item a new asset id; look for
+        # the one item in the inventory with the same class and instance as each
+        # missing asset that isn't already tracked by any of the player's
+        # registrations
+        # returns {old (asset_id, class_id, instance_id): new (asset_id, class_id, instance_id)}
+        missing = [key for key in missing if not self._is_gone(key) and self._unanswered.get(key, 0) >= self._relink_after]
+        if len(missing) == 0:
+            return {}
+
+        index = await self.get_inventory(user_id)
+        tracked_asset_ids = set(tracked_asset_ids)
 
         result = {}
-        url = self._build_item_info_url(item_tuples)
-        r = await loop.run_in_executor(None, requests.get, url)
+        for key in missing:
+            asset_id, class_id, instance_id = key
+            self._unanswered.pop(key, None)
+            if asset_id in index.assets: # still there, the lookup must have failed for another reason
+                continue
+            candidates = [a for a, ci in index.assets.items() if ci == (class_id, instance_id) and not a in tracked_asset_ids]
+            if len(candidates) == 1:
+                logging.info("asset {} of {} is now {}".format(asset_id, user_id, candidates[0]))
+                result[key] = (candidates[0], class_id, instance_id)
+                tracked_asset_ids.add(candidates[0])
+            else: # gone or ambiguous, don't ask about it again until the inventory is refreshed
+                logging.info("asset {} of {} is no longer in the inventory".format(asset_id, user_id))
+                self._gone_assets.put(key, time.monotonic())
+
+        return result
+
+    async def get_class_infos(self, keys):
+        # class info never changes for a given (class_id, instance_id), so look
+        # in memory first, then in the database, and only ask steam for the rest
+        result = {}
+        missing = []
+        for key in set(keys):
+            info = self._class_info.get(key)
+            if info is None:
+                missing.append(key)
+            else:
+                result[key] = info
+
+        if len(missing) > 0 and self._db is not None:
+            stored = await self._db.get_class_infos(missing)
+            for key, info in stored.items():
+                self._class_info.put(key, info)
+            result.update(stored)
+            missing = [key for key in missing if not key in stored]
+
+        if len(missing) == 0:
+            return result
+
+        url = self._build_item_info_url(missing)
+        r = await self._get('GetAssetClassInfo', url)
         if not r.status_code == 200: # error
             raise RuntimeError("failed to fetch items (status code {:d})".format(r.status_code))
         data = r.json()
         if not 'result' in data:
             raise RuntimeError("failed to fetch items: no 'result' key")
 
-        for asset_id, class_id, instance_id in item_tuples:
-            item = data['result']["{}_{}".format(class_id, instance_id)]
-            if not 'actions' in item: # not inspectable
+        fetched = {}
+        for class_id, instance_id in missing:
+            item = data['result'].get("{}_{}".format(class_id, instance_id))
+            if item is None or not 'name' in item: # unknown class
                 continue
-            for _, action in item['actions'].items():
+            inspect_link = None
+            for _, action in item.get('actions', {}).items():
                 if action['name'].startswith('Inspect'):
-                    inspect_link = self._build_inspect_url(action['link'], user_id, asset_id)
+                    inspect_link = action['link']
                     break
-            else: # failed to find inspect link
+            fetched[(class_id, instance_id)] = (item['name'], item['icon_url'], inspect_link)
+
+        for key, info in fetched.items():
+            self._class_info.put(key, info)
+        if len(fetched) > 0 and self._db is not None:
+            await self._db.add_class_infos(fetched)
+        result.update(fetched)
+        return result
+
+    async def get_items_info(self, user_id, item_tuples):
+        result = {}
+        item_tuples = [key for key in item_tuples if not self._is_gone(key)]
+        class_infos = await self.get_class_infos((class_id, instance_id) for _, class_id, instance_id in item_tuples)
+
+        # find the inspect parameters for each item
+        inspect = {}
+        for asset_id, class_id, instance_id in item_tuples:
+            info = class_infos.get((class_id, instance_id))
+            if info is None or info[2] is None: # unknown or not inspectable
                 continue
+            inspect_link = self._build_inspect_url(info[2], user_id, asset_id)
+            inspect[await self.parse_inspect_url(inspect_link)] = (asset_id, class_id, instance_id), info, inspect_link
 
-            s, a, d = await self.parse_inspect_url(inspect_link)
-            retry_count = 0
-            while retry_count < 5:
-                try:
-                    st_count = await loop.run_in_executor(None, self._client.get_item_killcount, s, a, d)
-                except (TypeError, ValueError) as e:
-                    # TODO: fix this dumb hack
-                    logging.info("failed to get st count for {} {} {}, retrying...".format(s, a, d))
-                    await asyncio.sleep(0.25)
-                    retry_count += 1
-                    continue
-                except Exception as e:
-                    logging.warning("failed to get st count for {} {} {}".format(s, a, d))
-                    logging.exception(e)
+        # request all killcounts at once, retrying only the ones that got no reply
+        counts = {}
+        retry_count = 0
+        gc_up = False
+        while retry_count < 5:
+            outstanding = [sad for sad in inspect if not sad in counts]
+            if len(outstanding) == 0:
                 break
-            if retry_count == 5:
-                logging.warning("too many failures on getting st count for {} {} {}".format(s, a, d))
-                continue
+            await self._limiter.acquire('gc_preview', len(outstanding))
+            try:
+                async with self._gc_limit:
+                    with request_duration.time('gc_preview'):
+                        counts.update(await self._gc.get_item_killcounts(outstanding))
+                requests_total.inc('gc_preview', 'ok')
+                gc_up = True
+            except ValueError as e:
+                requests_total.inc('gc_preview', 'error')
+                logging.info("failed to get st counts: {}".format(e))
+            except Exception as e:
+                requests_total.inc('gc_preview', 'error')
+                logging.warning("failed to get st counts")
+                logging.exception(e)
+                break
+            if len(counts) < len(inspect):
+                logging.info("missing st count for {:d} items, retrying...".format(len(inspect) - len(counts)))
+                await asyncio.sleep(0.25)
+                retry_count += 1
+
+        if len(inspect) > 0:
+            gc_retries.observe(retry_count)
+            if len(counts) < len(inspect):
+                gc_unanswered.inc(n=len(inspect) - len(counts))
 
-            result[(asset_id, class_id, instance_id)] = {
-                'stattrak': st_count,
-                'name': item['name'],
-                'image': self._build_item_preview_url(item['icon_url']),
+        for sad, (key, (name, icon_url, _), inspect_link) in inspect.items():
+            if not sad in counts:
+                logging.warning("too many failures on getting st count for {} {} {}".format(*sad))
+                if gc_up:
+                    self._unanswered[key] = self._unanswered.get(key, 0) + 1
+                continue
+            self._unanswered.pop(key, None)
+            result[key] = {
+                'stattrak': counts[sad],
+                'name': name,
+                'image': self._build_item_preview_url(icon_url),
                 'inspect': inspect_link
             }
 
         return result
 
     async def get_user_id(self, steam_profile_url):
-        loop = asyncio.get_event_loop()
         parsed = urllib.parse.urlparse(steam_profile_url)
         if not parsed.netloc in ('steamcommunity.com',): # not a profile url at all
             return None
@@ -152,7 +359,7 @@ class steamapi(object):
         if parts[0] == 'id': # resolve vanity url
             username = parsed.path.split('/')[1]
             url = self._build_resolve_url(parts[1])
-            r = await loop.run_in_executor(None, requests.get, url)
+            r = await self._get('ResolveVanityURL', url)
             if not r.status_code == 200: # error
                 return None
             data = r.json()
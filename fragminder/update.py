@@ -1,130 +1,141 @@
 from collections import defaultdict
 from datetime import datetime, timezone
-import discord
+from .async_utils import task_pool
+from .alerts import alert_engine
+from .metrics import cycle_duration, stage_duration
+import logging
 
 __all__ = ['do_update']
 
-class asset_dict (defaultdict):
-    def __missing__(self, key):
-        self[key] = self.default_factory(key)
-        return self[key]
-
-
-class asset_info (object):
-    def __init__(self, asset_id):
-        self.asset_id = asset_id
-        self.name = None
-        self.weapon_id = None
-        self.last_count = None
-        self.last_check = None
-        self.watches = []
-
-    def add_watch(self, watch_id, count):
-        self.watches.append((watch_id, count))
-    
-
-default_alert_deltas = [20, 10, 5, 3, 2, 1]
+engine = alert_engine()
 
 async def do_update(ctx):
 
-    users = await ctx.db.get_users()
-    online_users = await ctx.steam.get_active_players([steam_id for _, _, _, steam_id, _ in users])
-
-    for guild_id, user_id, discord_id, steam_id, alert_deltas in users:
-
-        if alert_deltas is not None:
-            alert_deltas = list(map(int, alert_deltas.split(",")))
-        else:
-            alert_deltas = default_alert_deltas
-
-        if steam_id in online_users:
-
-            # look up user
-            user = await ctx.fetch_user(discord_id)
-
-            # determine where we should send notifications for this user
-            channel_id = await ctx.db.get_guild(guild_id)
-            if channel_id:
-                dest = ctx.get_channel(channel_id)
-            else:
-                dest = user
-
-            # TODO: handle a user being registered in multiple guilds, in which case we should elide duplicate inventory lookups
-            watches = await ctx.db.get_user_watches(user_id)
-
-            if len(watches) == 0:
-                continue
-
-            # build lookup table for user's watched assets
-            assets = asset_dict(asset_info)
-            for watch_id, weapon_id, name, asset_id, class_id, instance_id, count, last_count, last_check in watches:
-                assets[(asset_id, class_id, instance_id)].name = name
-                assets[(asset_id, class_id, instance_id)].weapon_id = weapon_id
-                assets[(asset_id, class_id, instance_id)].last_count = last_count
-                assets[(asset_id, class_id, instance_id)].last_check = last_check
-                assets[(asset_id, class_id, instance_id)].add_watch(watch_id, count)
-
-            # get steam inventory data
-            data = await ctx.steam.get_items_info(steam_id, list(assets.keys()))
-
-            # find items which need alerting
-            alerts = []
-            for key, data in data.items():
-
-                a = assets[key]
-                await ctx.db.update_weapon(a.weapon_id, data['stattrak'], datetime.now(tz=timezone.utc).timestamp())
-
-                if a.last_count is None:
-                    a.last_count = 0
-
-                # check that count has changed since last update, otherwise do nothing
-                if data['stattrak'] > a.last_count:
-
-                    for watch_id, watch_count in a.watches:
-
-                        # check if we already hit the threshold
-                        if data['stattrak'] >= watch_count:
-                            await ctx.db.remove_watch(watch_id)
-                            alerts.append({
-                                'hit': True,
-                                'delta': 0,
-                                'watch_count': watch_count,
-                                'asset': a,
-                                'data': data
-                            })
-                            continue
-
-                        # determine the last alert we would have sent
-                        last_delta = watch_count - a.last_count
-                        try:
-                            last_alert = [a for a in alert_deltas if a >= last_delta][-1]
-                        except IndexError:
-                            last_alert = alert_deltas[0] + 1
-
-                        # determine the current alert we would send
-                        delta = watch_count - data['stattrak']
-                        try:
-                            this_alert = [a for a in alert_deltas if a >= delta][-1]
-                        except IndexError: # we haven't passed the first alert threshold yet
-                            continue
-
-                        # skip if this is a duplicate alert
-                        if last_alert == this_alert: 
-                            continue
-
-                        alerts.append({
-                            'hit': False,
-                            'delta': delta,
-                            'watch_count': watch_count,
-                            'asset': a,
-                            'data': data
-                        })
-            
-            for a in alerts:
-                embed = discord.Embed()
-                embed.set_image(url=a['data']['image'])
-                if a['hit']:
-                    msg = "{}: you've hit your goal of {:d} on your {:s} (`{:s}`)! hope you got the screenshot~~".format(user.mention, a['watch_count'], a['data']['name'], a['asset'].name)
-                else:
-                    msg = "{}: you're {:d} away from your goal of {:d} on your {:s} (`{:s}`)!".format(user.mention, a['delta'], a['watch_count'], a['data']['name'], a['asset'].name)
-                await dest.send(msg, embed=embed)
+    await ctx.steam.wait_ready()
+    with cycle_duration.time():
+        await poll_cycle(ctx)
+
+
+async def poll_cycle(ctx):
+
+    index = await ctx.db.watch_index()
+
+    # only look at players whose turn it is; until we learn otherwise, assume
+    # they should be backed off (offline players simply stay that way)
+    due = ctx.scheduler.due(index.players())
+    for steam_id in due:
+        ctx.scheduler.schedule(steam_id)
+
+    # database writes for the whole cycle are committed together at the end
+    async with ctx.db.batch() as batch:
+        # players are independent of each other, so process them in parallel,
+        # starting on each presence batch as soon as it arrives; alerts for a
+        # single user are still sent in order by that player's task
+        pool = task_pool(ctx.conf.getint('poll_workers', 8))
+        try:
+            async for online_users in ctx.steam.iter_active_players(due):
+                for steam_id in online_users:
+                    pool.submit(update_player(ctx, batch, index, steam_id))
+        finally:
+            await pool.join()
+
+
+async def update_player(ctx, batch, index, steam_id):
+
+    # a player may be registered in several guilds; look up each of their
+    # watched assets only once and share the result between registrations.
+    # commands may change the index while we wait on steam, so work from the
+    # weapons as they were when we started
+    weapons = defaultdict(list)
+    users = []
+    for user in index.users(steam_id):
+        watched = [w for w in user.weapons.values() if len(w.watches) > 0]
+        for w in watched:
+            weapons[w.key].append(w)
+        users.append((user, watched))
+
+    # get steam inventory data
+    with stage_duration.time('items_info'):
+        items = await ctx.steam.get_items_info(steam_id, list(weapons.keys()))
+
+    distance = None
+    for user, watched in users:
+        d = await update_user(ctx, batch, items, user, watched, index.channels.get(user.guild_id))
+        if d is not None and (distance is None or d < distance):
+            distance = d
+
+    # assets the gc keeps not answering for may have been given a new id; find
+    # them again with one inventory diff and carry on with the new ids. this
+    # comes after the alerts above, so those don't wait on the inventory, and
+    # relink_assets only fetches it for assets that have been missing for a
+    # few lookups in a row while the gc was up
+    missing = [key for key in weapons if not key in items]
+    if len(missing) > 0:
+        try:
+            with stage_duration.time('relink'):
+                # every weapon of every registration counts as tracked, not
+                # just the watched ones, so none of them is taken for a moved one
+                tracked = [w.key[0] for user in index.users(steam_id) for w in user.weapons.values()]
+                relinked = await ctx.steam.relink_assets(steam_id, missing, tracked)
+        except Exception as e:
+            logging.warning("failed to relink assets for {}".format(steam_id))
+            logging.exception(e)
+            relinked = {}
+        if len(relinked) > 0:
+            with stage_duration.time('items_info'):
+                relinked_items = await ctx.steam.get_items_info(steam_id, list(relinked.values()))
+            moved = {}
+            for old, new in relinked.items():
+                for w in weapons[old]:
+                    batch.relink_weapon(w.weapon_id, *new)
+                if new in relinked_items:
+                    moved[old] = relinked_items[new]
+            for user, watched in users:
+                watched = [w for w in watched if w.key in moved]
+                if len(watched) == 0:
+                    continue
+                d = await update_user(ctx, batch, moved, user, watched, index.channels.get(user.guild_id))
+                if d is not None and (distance is None or d < distance):
+                    distance = d
+
+    ctx.scheduler.schedule(steam_id, distance)
+
+
+async def update_user(ctx, batch, items, user, weapons, channel_id):
+
+    # find items which need alerting, and how close we are to the nearest watch;
+    # the index itself is only updated once the batch is written
+    alerts = []
+    distance = None
+    for w in weapons:
+
+        if not w.key in items: # lookup failed
+            continue
+        data = items[w.key]
+        now = datetime.now(tz=timezone.utc).timestamp()
+        batch.update_weapon(w.weapon_id, data['stattrak'], now)
+        if data['stattrak'] != w.last_count: # only changes are kept, to keep the history compact
+            batch.record_killcount(w.weapon_id, now, data['stattrak'])
+
+        weapon_alerts, d = engine.evaluate(user.alert_deltas, w.last_count, data['stattrak'], w.watches)
+        if d is not None and (distance is None or d < distance):
+            distance = d
+
+        for watch_id, watch_count, hit, delta in weapon_alerts:
+            if hit:
+                batch.remove_watch(watch_id)
+            alerts.append({
+                'hit': hit,
+                'delta': delta,
+                'watch_count': watch_count,
+                'weapon_name': w.name,
+                'item_name': data['name'],
+                'image': data['image']
+            })
+
+    # alerts are plain data so that they can be handed to another process
+    if len(alerts) > 0:
+        await ctx.send_alerts(user.discord_id, channel_id, alerts)
+
+    return distance
+
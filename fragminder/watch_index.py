@@ -0,0 +1,161 @@
+import random
+
+__all__ = ['watch_index']
+
+
+class watched_user (object):
+    __slots__ = ('user_id', 'guild_id', 'discord_id', 'steam_id', 'alert_deltas', 'weapons')
+
+    def __init__(self, user_id, guild_id, discord_id, steam_id, alert_deltas):
+        self.user_id = user_id
+        self.guild_id = guild_id
+        self.discord_id = discord_id
+        self.steam_id = steam_id
+        self.alert_deltas = alert_deltas
+        self.weapons = {}
+
+
+class watched_weapon (object):
+    # watches are (watch_id, count) kept sorted by count, which is the form
+    # the alert engine takes them in
+    __slots__ = ('weapon_id', 'user', 'name', 'key', 'last_count', 'last_check', 'watches')
+
+    def __init__(self, weapon_id, user, name, key, last_count, last_check):
+        self.weapon_id = weapon_id
+        self.user = user
+        self.name = name
+        self.key = key
+        self.last_count = last_count
+        self.last_check = last_check
+        self.watches = []
+
+
+class watch_index (object):
+    # in-memory copy of the users, weapons and watches the poller works from;
+    # loaded once and then kept up to date alongside every database write, so
+    # a poll cycle doesn't have to query or rebuild anything
+
+    def __init__(self):
+        self.channels = {}
+        self._users = {}
+        self._players = {}
+        self._weapons = {}
+        self._watches = {}
+        # bumped on every change other than poll results, so that copies of
+        # the index held elsewhere can tell when to refresh; starts at a
+        # random value so a restarted index doesn't look like an old one
+        self.version = random.getrandbits(62)
+
+    def players(self):
+        # steam ids with at least one watch
+        return [steam_id for steam_id, users in self._players.items() if any(len(w.watches) > 0 for u in users for w in u.weapons.values())]
+
+    def users(self, steam_id):
+        return self._players.get(steam_id, ())
+
+    def weapon(self, weapon_id):
+        return self._weapons.get(weapon_id)
+
+    def set_channel(self, guild_id, channel_id):
+        self.channels[guild_id] = channel_id
+        self.version += 1
+
+    def add_user(self, user_id, guild_id, discord_id, steam_id, alert_deltas=None):
+        user = self._users[user_id] = watched_user(user_id, guild_id, discord_id, steam_id, alert_deltas)
+        self._players.setdefault(steam_id, []).append(user)
+        self.version += 1
+        return user
+
+    def set_alert_deltas(self, user_id, alert_deltas):
+        user = self._users.get(user_id)
+        if user is not None:
+            user.alert_deltas = alert_deltas
+            self.version += 1
+
+    def add_weapon(self, weapon_id, user_id, name, asset_id, class_id, instance_id, last_count=None, last_check=None):
+        user = self._users.get(user_id)
+        if user is None:
+            return None
+        weapon = self._weapons[weapon_id] = watched_weapon(weapon_id, user, name, (asset_id, class_id, instance_id), last_count, last_check)
+        user.weapons[weapon_id] = weapon
+        self.version += 1
+        return weapon
+
+    def reid_weapon(self, user_id, asset_id, class_id, instance_id, name):
+        user = self._users.get(user_id)
+        if user is None:
+            return
+        for weapon in user.weapons.values():
+            if weapon.name == name:
+                weapon.key = (asset_id, class_id, instance_id)
+                self.version += 1
+
+    def relink_weapon(self, weapon_id, asset_id, class_id, instance_id):
+        weapon = self._weapons.get(weapon_id)
+        if weapon is not None:
+            weapon.key = (asset_id, class_id, instance_id)
+            self.version += 1
+
+    def rename_weapon(self, weapon_id, name):
+        weapon = self._weapons.get(weapon_id)
+        if weapon is not None:
+            weapon.name = name
+            self.version += 1
+
+    def update_weapon(self, weapon_id, last_count, last_check):
+        weapon = self._weapons.get(weapon_id)
+        if weapon is not None:
+            weapon.last_count = last_count
+            weapon.last_check = last_check
+
+    def add_watch(self, watch_id, weapon_id, count):
+        weapon = self._weapons.get(weapon_id)
+        if weapon is None:
+            return
+        weapon.watches.append((watch_id, count))
+        weapon.watches.sort(key=lambda w: w[1])
+        self._watches[watch_id] = weapon
+        self.version += 1
+
+    def remove_watch(self, watch_id):
+        weapon = self._watches.pop(watch_id, None)
+        if weapon is not None:
+            weapon.watches = [w for w in weapon.watches if w[0] != watch_id]
+            self.version += 1
+
+    def apply_batch(self, weapon_updates, removed_watches, relinked_weapons):
+        # takes the same parameter tuples as fmdb.write_batch
+        for last_count, last_check, weapon_id in weapon_updates:
+            self.update_weapon(weapon_id, last_count, last_check)
+        for watch_id, in removed_watches:
+            self.remove_watch(watch_id)
+        for asset_id, class_id, instance_id, weapon_id in relinked_weapons:
+            self.relink_weapon(weapon_id, asset_id, class_id, instance_id)
+
+    def export(self, shard_id=0, shard_count=1):
+        # the watched players of one shard as plain lists, for poll workers;
+        # all their registrations and weapons go along, since relinking has to
+        # know every asset that is already tracked
+        users = []
+        for steam_id, players in self._players.items():
+            if steam_id % shard_count != shard_id:
+                continue
+            if not any(len(w.watches) > 0 for u in players for w in u.weapons.values()):
+                continue
+            for u in players:
+                weapons = [(w.weapon_id, w.name) + w.key + (w.last_count, w.last_check, w.watches) for w in u.weapons.values()]
+                users.append((u.user_id, u.guild_id, u.discord_id, u.steam_id, u.alert_deltas, self.channels.get(u.guild_id), weapons))
+        return users
+
+    @classmethod
+    def from_export(cls, version, users):
+        res = cls()
+        for user_id, guild_id, discord_id, steam_id, alert_deltas, channel_id, weapons in users:
+            res.channels[guild_id] = channel_id
+            res.add_user(user_id, guild_id, discord_id, steam_id, alert_deltas)
+            for weapon_id, name, asset_id, class_id, instance_id, last_count, last_check, watches in weapons:
+                res.add_weapon(weapon_id, user_id, name, asset_id, class_id, instance_id, last_count, last_check)
+                for watch_id, count in watches:
+                    res.add_watch(watch_id, weapon_id, count)
+        res.version = version
+        return res